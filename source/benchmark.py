@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import signal
+import sys
+import tempfile
+import time
+import yaml
+import settings
+from journal import JournalFile, journal
+from programsManager import ProgramsManager
+from scheduler import Launcher
+from supervisor import supervisor
+
+
+def write_config(directory, programs, instances, marker=0):
+    config = {
+        f"bench_{index}": {"cmd": "sleep 1000", "count": instances} for index in range(programs)
+    }
+    # a reload benchmark changes a single line: the first program's cmd
+    config["bench_0"]["cmd"] = f"sleep {1000 + marker}"
+    config["bench_crash"] = {"cmd": "false", "auto_restart": "always", "auto_start": False}
+    path = os.path.join(directory, "bench.yaml")
+    with open(path, "w") as stream:
+        yaml.safe_dump(config, stream)
+    return path
+
+
+def running_processes(manager):
+    return [
+        process
+        for program in manager.programs()
+        for process in program.processes
+        if process.is_running()
+    ]
+
+
+def measure_spawn(manager, programs):
+    started = time.monotonic()
+    Launcher(programs).run()
+    elapsed = time.monotonic() - started
+    spawned = len(running_processes(manager))
+    return {
+        "processes": spawned,
+        "seconds": elapsed,
+        "per_second": spawned / elapsed if elapsed else None,
+    }
+
+
+def measure_exit_detection(manager, samples):
+    latencies = []
+    for process in running_processes(manager)[:samples]:
+        started = time.monotonic()
+        os.kill(process.popen.pid, signal.SIGKILL)
+        supervisor.wait_exit([process])
+        latencies.append(time.monotonic() - started)
+    latencies.sort()
+    if not latencies:
+        return {}
+    return {
+        "samples": len(latencies),
+        "median_ms": latencies[len(latencies) // 2] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def measure_idle_cpu(seconds):
+    cpu, wall = time.process_time(), time.monotonic()
+    time.sleep(seconds)
+    return {"cpu_percent": (time.process_time() - cpu) / (time.monotonic() - wall) * 100}
+
+
+def measure_crash_loop(manager, seconds):
+    program = manager.find(["bench_crash"])[0]
+    cpu, wall = time.process_time(), time.monotonic()
+    with program.lock:
+        program.execute()
+    time.sleep(seconds)
+    result = {
+        "cpu_percent": (time.process_time() - cpu) / (time.monotonic() - wall) * 100,
+        "restarts": program.processes[0].streak,
+    }
+    manager.stop([program])
+    return result
+
+
+def measure_reload(manager, directory, programs, instances):
+    write_config(directory, programs, instances, marker=1)
+    started = time.monotonic()
+    manager.reload()
+    return {"seconds": time.monotonic() - started}
+
+
+def measure_stop(manager):
+    started = time.monotonic()
+    manager.shutdown()
+    return {"seconds": time.monotonic() - started}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark taskmaster's spawn, reap, stop and reload paths."
+    )
+    parser.add_argument("--programs", type=int, default=10)
+    parser.add_argument("--instances", type=int, default=10)
+    parser.add_argument("--exit-samples", type=int, default=20)
+    parser.add_argument("--idle-seconds", type=float, default=2)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    options = parser.parse_args()
+
+    settings.MAX_PROCESSES = max(settings.MAX_PROCESSES, options.instances)
+    supervisor.start()
+    results = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "programs": options.programs,
+        "instances": options.instances,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        # keep a running taskmaster's state file, config cache and journal out of it
+        settings.CONFIG_CACHE = os.path.join(directory, "config.json")
+        if journal.file is not None:
+            journal.file.map.close()
+            journal.file = JournalFile(os.path.join(directory, "journal"), settings.JOURNAL_FILE_SIZE, 0)
+        path = write_config(directory, options.programs, options.instances)
+        manager = ProgramsManager([path])
+        manager.state.path = ""
+        manager.load()
+        results["spawn"] = measure_spawn(
+            manager, [program for program in manager.programs() if program.auto_start]
+        )
+        results["idle"] = measure_idle_cpu(options.idle_seconds)
+        results["exit_detection"] = measure_exit_detection(manager, options.exit_samples)
+        results["crash_loop"] = measure_crash_loop(manager, options.idle_seconds)
+        results["reload"] = measure_reload(manager, directory, options.programs, options.instances)
+        results["stop"] = measure_stop(manager)
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    report = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, "w") as stream:
+            stream.write(report + "\n")
+    else:
+        print(report)
+    return os.EX_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import select
+import struct
+import threading
+import time
+from log import logger as log
+
+
+def section_hash(section):
+    return hashlib.sha1(json.dumps(section, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def parse_yaml(data):
+    # imported here: a warm compiled cache never needs it
+    import yaml
+
+    sections = {}
+    for document in yaml.load_all(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
+        if document:
+            sections.update(document)
+    return sections
+
+
+class CompiledCache:
+    """Parsed sections per file digest and validated program specs per section
+    hash, kept in a JSON file so that a start with unchanged config files
+    neither parses YAML nor validates programs. `context` covers whatever else
+    the cached results depend on; any difference discards the whole cache."""
+
+    VERSION = 1
+
+    def __init__(self, path, context):
+        self.path = path
+        self.context = context
+        self.files = {}
+        self.specs = {}
+        self.dirty = False
+        self._read()
+
+    def _read(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as stream:
+                data = json.load(stream)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != self.VERSION or data.get("context") != self.context:
+            return
+        self.files = data.get("files", {})
+        self.specs = data.get("specs", {})
+
+    def sections(self, digest):
+        return self.files.get(digest)
+
+    def put_sections(self, digest, sections):
+        try:
+            if json.loads(json.dumps(sections)) != sections:
+                return
+        except (TypeError, ValueError):
+            return
+        self.files[digest] = sections
+        self.dirty = True
+
+    def spec(self, section_hash):
+        return self.specs.get(section_hash)
+
+    def put_spec(self, section_hash, spec):
+        self.specs[section_hash] = spec
+        self.dirty = True
+
+    def save(self, digests, hashes):
+        """Write the cache, keeping only entries for the current files and sections."""
+        files = {digest: self.files[digest] for digest in digests if digest in self.files}
+        specs = {value: self.specs[value] for value in hashes if value in self.specs}
+        if not self.path or not (self.dirty or len(files) < len(self.files) or len(specs) < len(self.specs)):
+            return
+        self.files, self.specs, self.dirty = files, specs, False
+        data = {"version": self.VERSION, "context": self.context, "files": files, "specs": specs}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as stream:
+                json.dump(data, stream, separators=(",", ":"), default=int)
+            os.replace(f"{self.path}.tmp", self.path)
+        except (OSError, TypeError, ValueError) as e:
+            log.log(f"cannot write config cache {self.path}: {e}")
+
+
+class ConfigFile:
+
+    def __init__(self, path, compiled=None):
+        self.path = path
+        self.compiled = compiled
+        self.stat_key = None
+        self.digest = None
+        self.sections = {}
+
+    def refresh(self):
+        """Re-read the file only if its stat changed, and re-parse it only if
+        its content did; returns True when the sections changed."""
+        st = os.stat(self.path)
+        stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stat_key == self.stat_key:
+            return False
+        with open(self.path, "rb") as stream:
+            data = stream.read()
+        self.stat_key = stat_key
+        digest = hashlib.sha256(data).hexdigest()
+        if digest == self.digest:
+            return False
+        sections = self.compiled.sections(digest) if self.compiled else None
+        if sections is None:
+            sections = parse_yaml(data)
+            if self.compiled:
+                self.compiled.put_sections(digest, sections)
+        self.digest = digest
+        self.sections = sections
+        return True
+
+
+class ConfigCache:
+    """Merged view of several YAML files; later files override earlier ones."""
+
+    def __init__(self, files, compiled=None):
+        self.compiled = compiled
+        self.files = [ConfigFile(path, compiled) for path in files]
+        self.sections = None
+        self.hashes = {}
+
+    def load(self):
+        """Returns (sections, hashes, changed)."""
+        try:
+            changed = [config_file.refresh() for config_file in self.files]
+        except Exception:
+            raise ValueError(f"Can't parse configuration file.")
+        if self.sections is not None and not any(changed):
+            return self.sections, self.hashes, False
+        sections = {}
+        for config_file in self.files:
+            sections.update(config_file.sections)
+        if not all(isinstance(section, dict) for section in sections.values()):
+            raise ValueError(f"Can't parse configuration file.")
+        self.hashes = {name: section_hash(section) for name, section in sections.items()}
+        self.sections = sections
+        return sections, self.hashes, True
+
+    def save_compiled(self):
+        if self.compiled is not None:
+            self.compiled.save([config_file.digest for config_file in self.files], self.hashes.values())
+
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_EVENT = struct.Struct("iIII")
+
+
+class ConfigWatcher:
+    """Calls on_change once the config files have been quiet for `debounce`
+    seconds. Uses inotify on the files' directories (editors often replace
+    files by renaming), falling back to stat polling."""
+
+    def __init__(self, files, on_change, debounce=0.5, poll_interval=2):
+        self.paths = {os.path.abspath(path) for path in files}
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.directories = {}
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def _inotify(self):
+        import ctypes
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        for directory in {os.path.dirname(path) for path in self.paths}:
+            wd = libc.inotify_add_watch(fd, directory.encode(), mask)
+            if wd < 0:
+                os.close(fd)
+                return None
+            self.directories[wd] = directory
+        return fd
+
+    def _touched(self, data):
+        offset = 0
+        while offset + IN_EVENT.size <= len(data):
+            wd, _, _, length = IN_EVENT.unpack_from(data, offset)
+            offset += IN_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            if os.path.join(self.directories.get(wd, ""), name) in self.paths:
+                return True
+        return False
+
+    def _stat(self):
+        stats = {}
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stats[path] = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except OSError:
+                stats[path] = None
+        return stats
+
+    def run(self):
+        fd = self._inotify()
+        stats = self._stat() if fd is None else None
+        deadline = None
+        while True:
+            timeout = self.poll_interval if fd is None else None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            ready = select.select([fd], [], [], timeout)[0] if fd is not None else time.sleep(timeout)
+            if ready:
+                try:
+                    touched = self._touched(os.read(fd, 65536))
+                except BlockingIOError:
+                    touched = False
+            elif fd is None:
+                current = self._stat()
+                touched, stats = current != stats, current
+            else:
+                touched = False
+            if touched:
+                deadline = time.monotonic() + self.debounce
+            elif deadline is not None and time.monotonic() >= deadline:
+                deadline = None
+                log.log("configuration changed, reloading")
+                try:
+                    self.on_change()
+                except Exception as e:
+                    log.log(f"automatic reload failed: {e}")
@@ -0,0 +1,261 @@
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import threading
+from log import logger as log
+from listeners import parse_address
+from journal import journal, parse_since
+from scheduler import RollingRestart
+from supervisor import supervisor
+from status import board
+import settings
+import time
+
+
+class Controller:
+    """Executes control requests of the form {"cmd": name, "args": [...]}."""
+
+    def __init__(self, programs):
+        self.programs = programs
+
+    def execute(self, request):
+        try:
+            handler = getattr(self, f"cmd_{request['cmd']}", None)
+            if handler is None:
+                raise ValueError(f"unknown command {request['cmd']}")
+            args = request.get("args", [])
+            if not isinstance(args, list):
+                raise ValueError("args should be a list")
+            return {"ok": True, "result": handler([str(arg) for arg in args])}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+    def _find(self, args):
+        programs = self.programs.find(args)
+        missing = sorted(set(args) - {program.name for program in programs})
+        return programs, missing
+
+    def _selected(self, args):
+        if args:
+            return self._find(args)
+        return self.programs.programs(), []
+
+    def cmd_start(self, args):
+        programs, missing = self._find(args)
+        for program in programs:
+            with program.lock:
+                log.log(f"start {program.name}")
+                program.execute()
+        return {"done": [program.name for program in programs], "missing": missing}
+
+    def cmd_stop(self, args):
+        programs, missing = self._find(args)
+        self.programs.stop(programs)
+        for program in programs:
+            log.log(f"stop {program.name}")
+        return {"done": [program.name for program in programs], "missing": missing}
+
+    def cmd_restart(self, args):
+        if "--rolling" in args:
+            return self._rolling_restart([arg for arg in args if arg != "--rolling"])
+        programs, missing = self._find(args)
+        for program in programs:
+            with program.lock:
+                program.restart()
+                log.log(f"restart: [{program.name}]")
+        return {"done": [program.name for program in programs], "missing": missing}
+
+    def _rolling_restart(self, args):
+        batch = 1
+        if "--batch" in args:
+            index = args.index("--batch")
+            value = args[index + 1] if index + 1 < len(args) else ""
+            args = args[:index] + args[index + 2 :]
+            if not value.isdigit() or int(value) < 1:
+                raise ValueError("usage: restart --rolling [--batch N] <program>...")
+            batch = int(value)
+        programs, missing = self._find(args)
+        results = {program.name: RollingRestart(program, batch).run() for program in programs}
+        return {"programs": results, "missing": missing}
+
+    def _snapshot(self, args, full=False):
+        snapshot = board.current(full).programs
+        names = args or list(snapshot)
+        missing = sorted(name for name in names if name not in snapshot)
+        return [(name, snapshot[name]) for name in names if name in snapshot], missing
+
+    def cmd_status(self, args):
+        entries, missing = self._snapshot(args)
+        status = {
+            name: {key: value for key, value in entry.items() if key != "processes"}
+            for name, entry in entries
+        }
+        return {"programs": status, "missing": missing}
+
+    def cmd_full_status(self, args):
+        entries, missing = self._snapshot(args, full=True)
+        now = time.time()
+        status = {
+            name: {
+                **entry,
+                "processes": [
+                    dict(process, elapsed=round((process["ended"] or now) - process["started"], 3))
+                    for process in entry["processes"]
+                ],
+            }
+            for name, entry in entries
+        }
+        return {"programs": status, "missing": missing}
+
+    def cmd_tail(self, args):
+        if not args or len(args) > 2 or args[1:] not in ([], ["stdout"], ["stderr"]):
+            raise ValueError("usage: tail <program> [stdout|stderr]")
+        programs, missing = self._find(args[:1])
+        output = {}
+        for program in programs:
+            with program.lock:
+                output[program.name] = [
+                    {"pid": pid, "output": data.decode(errors="replace")}
+                    for pid, data in program.tail(*args[1:])
+                ]
+        return {"programs": output, "missing": missing}
+
+    def cmd_stats(self, args):
+        sort = "cpu"
+        if "--sort" in args:
+            index = args.index("--sort")
+            sort = args[index + 1] if index + 1 < len(args) else ""
+            args = args[:index] + args[index + 2 :]
+        programs, missing = self._selected(args)
+        return {"processes": self.programs.sampler.rows(programs, sort), "missing": missing}
+
+    def cmd_history(self, args):
+        since = 0
+        if "--since" in args:
+            index = args.index("--since")
+            if index + 1 >= len(args):
+                raise ValueError("usage: history <program>... [--since DURATION|DATE]")
+            since = parse_since(args[index + 1])
+            args = args[:index] + args[index + 2 :]
+        if not args:
+            raise ValueError("usage: history <program>... [--since DURATION|DATE]")
+        return {"events": journal.history(args, since)}
+
+    def cmd_reload(self, args):
+        self.programs.reload()
+        return {"programs": sorted(program.name for program in self.programs.programs())}
+
+    def cmd_upgrade(self, args):
+        # give the reply a moment to leave before the process image is replaced
+        supervisor.call_later(0.2, None, self.programs.reexec)
+        return {"pid": os.getpid()}
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Newline-delimited JSON: one request (or a list of requests) per line,
+    answered by one response (or a list of responses) per line. A `watch`
+    request instead streams status changes until the client hangs up."""
+
+    def handle(self):
+        controller = self.server.controller
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"ok": False, "error": f"invalid request ({e})"}
+            else:
+                if isinstance(request, dict) and request.get("cmd") == "watch":
+                    return self.watch(request.get("args", []))
+                if isinstance(request, list):
+                    response = [controller.execute(command) for command in request]
+                else:
+                    response = controller.execute(request)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+    def watch(self, names):
+        try:
+            for changes in board.watch(set(map(str, names))):
+                self.wfile.write(json.dumps({"ok": True, "result": changes}).encode() + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, programs):
+        self.path = path
+        self.controller = Controller(programs)
+        self._remove_stale_socket()
+        super().__init__(path, ControlHandler)
+        os.chmod(path, 0o600)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)
+                return
+        raise ValueError(f"another taskmaster is listening on {self.path}")
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        log.log(f"control socket listening on {self.path}")
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ControlTCPServer(socketserver.ThreadingTCPServer):
+    """The same protocol on a TCP address, for aggregators (see fleet.py).
+    Requests are not authenticated, so only loopback addresses are accepted
+    unless TASKMASTER_CONTROL_ALLOW_REMOTE is set."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    @staticmethod
+    def check(address, allow_remote=settings.CONTROL_ALLOW_REMOTE):
+        family, target = parse_address(address)
+        if family == socket.AF_UNIX:
+            raise ValueError(f"use TASKMASTER_SOCKET for unix control sockets, not {address}")
+        host = target[0]
+        try:
+            loopback = host == "localhost" or ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            loopback = False
+        if not loopback and not allow_remote:
+            raise ValueError(
+                f"control address {address} is not loopback; "
+                "set TASKMASTER_CONTROL_ALLOW_REMOTE=1 to expose it without authentication"
+            )
+        return family, target
+
+    def __init__(self, address, programs):
+        self.address_family, target = self.check(address)
+        self.address = address
+        self.controller = Controller(programs)
+        super().__init__(target, ControlHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        log.log(f"control address listening on {self.address}")
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
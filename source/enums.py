@@ -39,3 +39,39 @@ class AutoRestart(IntEnum):
                 f"Auto retart should be one of the following values {AutoRestart.__members__.keys}"
             )
 
+
+
+class ShellMode(IntEnum):
+    NEVER = 0
+    AUTO = 1
+    ALWAYS = 2
+
+    @classmethod
+    def from_value(cls, value):
+        if isinstance(value, bool):
+            return cls.ALWAYS if value else cls.NEVER
+        if isinstance(value, str) and value.upper() in cls.__members__:
+            return cls[value.upper()]
+        raise ValueError(
+            f"Shell should be true, false or one of the following values {ShellMode.__members__.keys}"
+        )
+
+
+class ProcessState(IntEnum):
+    IDLE = 0
+    RUNNING = 1
+    SUCCESS = 2
+    FAILED = 3
+    STOPPED = 4
+
+
+class JournalEvent(IntEnum):
+    SPAWN = 1
+    EXIT = 2
+    BACKOFF = 3
+    RESTART = 4
+    STOP = 5
+    KILL = 6
+    GIVE_UP = 7
+    UNHEALTHY = 8
+    ADOPT = 9
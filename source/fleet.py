@@ -0,0 +1,138 @@
+import json
+from listeners import parse_address
+from sampler import COLUMNS
+import settings
+
+# one response line per node; full_status of thousands of instances is megabytes
+READ_LIMIT = 256 * 1024 * 1024
+
+
+def parse_endpoint(endpoint):
+    """`host:port` (or `tcp://host:port`) for TCP, anything else is a socket path."""
+    if endpoint.startswith("unix:"):
+        return "unix", endpoint[len("unix:") :]
+    if endpoint.startswith("tcp://") or endpoint.rpartition(":")[2].isdigit() and "/" not in endpoint:
+        return "tcp", parse_address(endpoint)[1]
+    return "unix", endpoint
+
+
+class Fleet:
+    """Sends the same batch of control requests to many taskmasters at once:
+    every node gets one connection and one round trip, at most `concurrency`
+    of them in flight, each bounded by `timeout` seconds."""
+
+    def __init__(self, endpoints, concurrency=settings.FLEET_CONCURRENCY, timeout=settings.FLEET_TIMEOUT):
+        self.endpoints = {endpoint: parse_endpoint(endpoint) for endpoint in endpoints}
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def send(self, commands):
+        """{endpoint: list of responses, or the error that node failed with}."""
+        # imported here, off the single-node path: asyncio is slow to import
+        import asyncio
+
+        return asyncio.run(self._send_all(commands))
+
+    async def _send_all(self, commands):
+        import asyncio
+
+        slots = asyncio.Semaphore(self.concurrency)
+        line = json.dumps(commands).encode() + b"\n"
+
+        async def send(endpoint):
+            async with slots:
+                try:
+                    return endpoint, await asyncio.wait_for(self._send(endpoint, line), self.timeout)
+                except asyncio.TimeoutError:
+                    return endpoint, f"no answer within {self.timeout}s"
+                except (OSError, ValueError) as e:
+                    return endpoint, str(e) or type(e).__name__
+
+        return dict(await asyncio.gather(*(send(endpoint) for endpoint in self.endpoints)))
+
+    async def _send(self, endpoint, line):
+        import asyncio
+
+        kind, target = self.endpoints[endpoint]
+        if kind == "unix":
+            reader, writer = await asyncio.open_unix_connection(target, limit=READ_LIMIT)
+        else:
+            reader, writer = await asyncio.open_connection(*target, limit=READ_LIMIT)
+        try:
+            writer.write(line)
+            await writer.drain()
+            responses = json.loads(await reader.readline())
+        finally:
+            writer.close()
+        if not isinstance(responses, list):
+            raise ValueError(responses.get("error", "unexpected response"))
+        return responses
+
+    def execute(self, commands):
+        """One merged response per command, in the single-node response format;
+        nodes that failed are listed under the result's `errors`."""
+        replies = self.send(commands)
+        merged = []
+        for index, command in enumerate(commands):
+            results, errors = {}, {}
+            for endpoint, reply in replies.items():
+                if isinstance(reply, str):
+                    errors[endpoint] = reply
+                elif reply[index]["ok"]:
+                    results[endpoint] = reply[index]["result"]
+                else:
+                    errors[endpoint] = reply[index]["error"]
+            if not results:
+                merged.append({"ok": False, "error": "; ".join(f"{node}: {e}" for node, e in errors.items())})
+                continue
+            merge = getattr(self, f"merge_{command['cmd']}", self.merge_default)
+            merged.append({"ok": True, "result": dict(merge(command, results), errors=errors)})
+        return merged
+
+    @staticmethod
+    def _missing(results):
+        """Programs that no node that answered knows about."""
+        missing = [set(result.get("missing", ())) for result in results.values()]
+        return sorted(set.intersection(*missing))
+
+    def merge_default(self, command, results):
+        return {"nodes": results}
+
+    def merge_start(self, command, results):
+        return {
+            "done": {node: result["done"] for node, result in results.items()},
+            "missing": self._missing(results),
+        }
+
+    merge_stop = merge_start
+
+    def merge_restart(self, command, results):
+        if "--rolling" in command.get("args", ()):
+            return self.merge_default(command, results)
+        return self.merge_start(command, results)
+
+    def merge_status(self, command, results):
+        """Per node entries, plus counters summed over the fleet per program."""
+        totals = {}
+        for result in results.values():
+            for name, entry in result["programs"].items():
+                total = totals.setdefault(name, {})
+                for key, value in entry.items():
+                    if key != "processes":
+                        total[key] = total.get(key, 0) + value
+        return {
+            "programs": {node: result["programs"] for node, result in results.items()},
+            "totals": totals,
+            "missing": self._missing(results),
+        }
+
+    merge_full_status = merge_status
+
+    def merge_stats(self, command, results):
+        args = command.get("args", [])
+        index = args.index("--sort") if "--sort" in args else -1
+        sort = args[index + 1] if 0 <= index < len(args) - 1 else "cpu"
+        rows = [dict(row, node=node) for node, result in results.items() for row in result["processes"]]
+        if sort in COLUMNS:
+            rows.sort(key=lambda row: row[sort], reverse=True)
+        return {"processes": rows, "missing": self._missing(results)}
@@ -0,0 +1,138 @@
+import functools
+import os
+import threading
+import time
+from log import logger as log
+from supervisor import supervisor
+import settings
+
+KINDS = ("tcp", "http", "cmd")
+
+
+class Probe:
+    """A program's health check, run against each of its running instances."""
+
+    def __init__(self, config):
+        self.kind = config["type"]
+        self.host = config.get("host", "127.0.0.1")
+        self.port = config.get("port", 0)
+        self.path = config.get("path", "/")
+        self.command = config.get("command", "")
+        self.interval = config.get("interval", 10)
+        self.timeout = config.get("timeout", 2)
+        self.failures = config.get("failures", 3)
+        self.delay = config.get("delay", 0)
+
+    @staticmethod
+    def validate(config):
+        if not isinstance(config, dict) or config.get("type") not in KINDS:
+            raise ValueError(f"health_check needs a type among {', '.join(KINDS)}")
+        if config["type"] == "cmd" and not isinstance(config.get("command"), str):
+            raise ValueError("a cmd health_check needs a command")
+        if config["type"] != "cmd" and not isinstance(config.get("port"), int):
+            raise ValueError(f"a {config['type']} health_check needs a port")
+        for name in ("interval", "timeout", "delay"):
+            value = config.get(name, 0)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"health_check {name} should be a non-negative number of seconds")
+        failures = config.get("failures", 3)
+        if isinstance(failures, bool) or not isinstance(failures, int) or failures < 1:
+            raise ValueError("health_check failures should be a positive integer")
+        return config
+
+    async def check(self, process):
+        import asyncio
+
+        try:
+            return await asyncio.wait_for(getattr(self, f"_{self.kind}")(process), self.timeout)
+        except (OSError, asyncio.TimeoutError, ValueError):
+            return False
+
+    async def _tcp(self, process):
+        import asyncio
+
+        _, writer = await asyncio.open_connection(self.host, self.port)
+        writer.close()
+        return True
+
+    async def _http(self, process):
+        import asyncio
+
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(f"GET {self.path} HTTP/1.0\r\nHost: {self.host}\r\n\r\n".encode())
+            status = (await reader.readline()).split()
+            return len(status) > 1 and 200 <= int(status[1]) < 400
+        finally:
+            writer.close()
+
+    async def _cmd(self, process):
+        import asyncio
+
+        env = dict(
+            process.env or os.environ,
+            TASKMASTER_PID=str(process.popen.pid),
+            TASKMASTER_INSTANCE=str(process.instance),
+        )
+        child = await asyncio.create_subprocess_shell(
+            self.command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+            env=env,
+        )
+        try:
+            return await child.wait() == 0
+        finally:
+            if child.returncode is None:
+                child.kill()
+
+
+class HealthChecker:
+    """Runs every program's probes on one asyncio loop in a background thread;
+    results are handed to Program.health_result under the program's lock."""
+
+    def __init__(self, programs, tick=0.5, concurrency=settings.HEALTH_CONCURRENCY):
+        self.programs = programs
+        self.tick = tick
+        self.concurrency = concurrency
+        self.probing = set()
+
+    def start(self):
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def loop(self):
+        # imported here, off the startup path: asyncio is slow to import
+        import asyncio
+
+        asyncio.run(self.run())
+
+    async def run(self):
+        import asyncio
+
+        self.slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            now = time.monotonic()
+            for program in self.programs.programs():
+                if program.probe is None:
+                    continue
+                for process in list(program.processes):
+                    if process in self.probing or not process.is_running():
+                        continue
+                    if now < process.health_due or now < process.start + program.probe.delay:
+                        continue
+                    process.health_due = now + program.probe.interval
+                    self.probing.add(process)
+                    asyncio.create_task(self.probe(program, process, process.popen))
+            await asyncio.sleep(self.tick)
+
+    async def probe(self, program, process, popen):
+        try:
+            async with self.slots:
+                healthy = await program.probe.check(process)
+        except Exception as e:
+            log.log(f"[{program.name}] health check error: {e}")
+            healthy = False
+        finally:
+            self.probing.discard(process)
+        supervisor.submit(program.lock, functools.partial(program.health_result, process, popen, healthy))
@@ -1,6 +1,12 @@
 import cmd
 import signal
 from log import logger as log
+from scheduler import RollingRestart
+from journal import journal, parse_since
+from program import STATE_COLORS
+from status import board
+import datetime
+import time
 import subprocess
 
 
@@ -8,8 +14,7 @@ class Interface(cmd.Cmd):
 
     prompt = "\033[1;32mTaskmaster > \033[0m"
 
-    def __init__(self, programs, lock):
-        self.lock = lock
+    def __init__(self, programs):
         self.programs = programs
         signal.signal(signal.SIGINT, self.sigint_handler)
         signal.signal(signal.SIGHUP, self.sighup_handler)
@@ -37,85 +42,162 @@ class Interface(cmd.Cmd):
         return True
 
     def do_start(self, args):
-        self.lock.acquire(True)
-        for arg in args.split():
-            if arg in self.programs.programs_dict:
-                program = self.programs.programs_dict[arg]
+        for program in self.programs.find(args.split()):
+            with program.lock:
                 log.log(f"start {program.name}")
                 program.execute()
-        self.lock.release()
 
     def do_stop(self, args):
-        self.lock.acquire(True)
-        for arg in args.split():
-            if arg in self.programs.programs_dict:
-                program = self.programs.programs_dict[arg]
-                program.kill()
-                log.log(f"stop {program.name}")
-        self.lock.release()
+        programs = self.programs.find(args.split())
+        self.programs.stop(programs)
+        for program in programs:
+            log.log(f"stop {program.name}")
+
+    def print_status(self, name, entry):
+        counters = {key: value for key, value in entry.items() if key != "processes"}
+        print(f"program: {name}\n↳ " + ", ".join(f"{k}: {v}" for k, v in counters.items()))
+
+    def print_processes(self, entry):
+        for process in entry["processes"]:
+            state = process["state"]
+            elapsed = datetime.timedelta(seconds=(process["ended"] or time.time()) - process["started"])
+            print(f"↳ {process['id']} [pid:{process['pid']}]", end="")
+            print(f" \033[{STATE_COLORS[state]}m{state}\033[0m ({elapsed})", end="")
+            if state in ("failed", "success"):
+                print(f" [code:{process['code']}]", end="")
+            print()
+
+    def _snapshot_entries(self, args, full=False):
+        snapshot = board.current(full).programs
+        names = args.split() or list(snapshot)
+        extra = [name for name in names if name not in snapshot]
+        if extra:
+            print(f'\033[33mprograms not found: {" ".join(extra)}\033[0m')
+        return [(name, snapshot[name]) for name in names if name in snapshot]
 
     def do_status(self, args):
-        self.lock.acquire(True)
-
-        if args:
-            found = {}
-            extra = []
-            for arg in args.split():
-                for program in self.programs.programs():
-                    if program.name == arg and arg not in found.keys():
-                        found[program.name] = program
-                        break
-                if arg not in found.keys():
-                    extra.append(arg)
-            if found:
-                for name in found:
-                    found[name].status()
-            if extra:
-                print(f'\033[33mprograms not found: {" ".join(set(extra))}\033[0m')
-        else:
-            self.programs.status()
-
-        self.lock.release()
+        for name, entry in self._snapshot_entries(args):
+            self.print_status(name, entry)
 
     def do_full_status(self, args):
-        self.lock.acquire(True)
-        if args:
-            for arg in args.split():
-                if arg in self.programs.programs_dict:
-                    program = self.programs.programs_dict[arg]
-                    program.full_status()
-        else:
-            self.programs.full_status()
-        self.lock.release()
+        for name, entry in self._snapshot_entries(args, full=True):
+            self.print_status(name, entry)
+            self.print_processes(entry)
+
+    def do_watch(self, args):
+        """Print status changes as they happen, until Ctrl-C."""
+        names = set(args.split())
+        handler = signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            for changes in board.watch(names):
+                for name, entry in changes["changed"].items():
+                    self.print_status(name, entry)
+                    self.print_processes(entry)
+                for name in changes["removed"]:
+                    print(f"program: {name} removed")
+        except KeyboardInterrupt:
+            print()
+        finally:
+            signal.signal(signal.SIGINT, handler)
+
+    def do_tail(self, args):
+        words = args.split()
+        if not words or len(words) > 2 or words[1:] not in ([], ["stdout"], ["stderr"]):
+            print(f"\033[33mWarning:\033[0m usage: tail <program> [stdout|stderr]")
+            return
+        for program in self.programs.find(words[:1]):
+            with program.lock:
+                output = program.tail(*words[1:])
+            for pid, data in output:
+                print(f"\033[1m==> {program.name} [pid:{pid}] <==\033[0m")
+                print(data.decode(errors="replace"), end="" if data.endswith(b"\n") else "\n")
+
+    def do_stats(self, args):
+        words = args.split()
+        sort = "cpu"
+        if "--sort" in words:
+            index = words.index("--sort")
+            sort = words[index + 1] if index + 1 < len(words) else ""
+            del words[index : index + 2]
+        programs = self.programs.find(words) if words else self.programs.programs()
+        try:
+            rows = self.programs.sampler.rows(programs, sort)
+        except ValueError as e:
+            print(f"\033[33mWarning:\033[0m {e}")
+            return
+        print(f"{'PROGRAM':<20} {'PID':>8} {'CPU%':>6} {'RSS':>10} {'THREADS':>7} {'FDS':>5} {'IO/s':>10}")
+        for row in rows:
+            print(
+                f"{row['program']:<20} {row['pid']:>8} {row['cpu']:>6} {row['rss'] // 1024:>8}kB"
+                f" {row['threads']:>7} {row['fds']:>5} {row['io']:>10}"
+            )
+
+    def do_history(self, args):
+        words = args.split()
+        since = 0
+        try:
+            if "--since" in words:
+                index = words.index("--since")
+                since = parse_since(words[index + 1] if index + 1 < len(words) else "")
+                del words[index : index + 2]
+            if not words:
+                raise ValueError("usage: history <program>... [--since DURATION|DATE]")
+        except ValueError as e:
+            print(f"\033[33mWarning:\033[0m {e}")
+            return
+        for event in journal.history(words, since):
+            when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event["time"]))
+            print(
+                f"{when} {event['program']:<20} {event['event']:<9} #{event['instance']}"
+                f" [pid:{event['pid']}] code:{event['code']} {event['value']:g}"
+            )
 
     def do_restart(self, args):
-        if not args:
+        words = args.split()
+        if "--rolling" in words:
+            return self.rolling_restart(words)
+        if not words:
             return
-        self.lock.acquire(True)
-        for arg in args.split():
-            if arg in self.programs.programs_dict:
-                program = self.programs.programs_dict[arg]
+        for program in self.programs.find(words):
+            with program.lock:
                 program.restart()
                 log.log(f"restart: [{program.name}]")
-        self.lock.release()
+
+    def rolling_restart(self, words):
+        words.remove("--rolling")
+        batch = 1
+        if "--batch" in words:
+            index = words.index("--batch")
+            value = words[index + 1] if index + 1 < len(words) else ""
+            del words[index : index + 2]
+            if not value.isdigit() or int(value) < 1:
+                print(f"\033[33mWarning:\033[0m usage: restart --rolling [--batch N] <program>...")
+                return
+            batch = int(value)
+        for program in self.programs.find(words):
+            result = RollingRestart(program, batch).run()
+            if result["aborted"]:
+                print(
+                    f"\033[33mWarning:\033[0m {program.name}: rollout aborted after "
+                    f"{result['restarted']} instances, {result['failed']} failed to start"
+                )
+            else:
+                print(f"{program.name}: {result['restarted']} instances restarted")
 
     def do_full_restart(self, args):
-        self.lock.acquire(True)
         if args:
             print(f"\033[33mWarning:\033[0m full_restart don't take any arguments")
-        else:
-            for program in self.programs.programs():
-                program.kill()
-                program.execute()
-        self.lock.release()
+            return
+        self.programs.full_restart()
 
     def do_reload(self, args):
         try:
-            self.lock.acquire(True)
             self.programs.reload()
         except Exception as e:
             print(f"\033[33mWarning:\033[0m error reloading ({str(e)})")
-        self.lock.release()
+
+    def do_upgrade(self, args):
+        self.programs.reexec()
 
     def emptyline(self):
         pass
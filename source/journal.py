@@ -0,0 +1,178 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+from enums import JournalEvent
+from log import logger as log
+import settings
+
+# time, program, event, instance, pid, code, value; padded to 64 bytes
+RECORD = struct.Struct("<d32sBHiid5x")
+
+
+def decode(fields):
+    timestamp, program, event, instance, pid, code, value = fields
+    return {
+        "time": timestamp,
+        "program": program.rstrip(b"\0").decode(errors="replace"),
+        "event": JournalEvent(event).name.lower(),
+        "instance": instance,
+        "pid": pid,
+        "code": code,
+        "value": round(value, 6),
+    }
+
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_since(value):
+    """`90`, `15m`, `2h`, `1d` ago, or an ISO date, to a timestamp."""
+    if value[-1:] in UNITS and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * UNITS[value[-1]]
+    if value.replace(".", "", 1).isdigit():
+        return time.time() - float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"--since takes a duration (90, 15m, 2h, 1d) or an ISO date, not {value}")
+
+
+def first_after(buffer, count, since):
+    """Index of the first of `count` time-ordered records at or after `since`."""
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if RECORD.unpack_from(buffer, middle * RECORD.size)[0] < since:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def used(buffer, capacity):
+    """Number of records written to a preallocated buffer: unused records are zero."""
+    low, high = 0, capacity
+    while low < high:
+        middle = (low + high) // 2
+        if RECORD.unpack_from(buffer, middle * RECORD.size)[0] == 0:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def scan(buffer, count, since):
+    start = first_after(buffer, count, since)
+    return RECORD.iter_unpack(buffer[start * RECORD.size : count * RECORD.size])
+
+
+class JournalFile:
+    """Preallocated, mmap'd append-only file of records. Unused space is zero,
+    so the end is found by looking for the first record with time 0; when
+    the file is full it is rotated like captured output."""
+
+    def __init__(self, path, size, backups):
+        self.path = path
+        self.capacity = max(size // RECORD.size, 1)
+        self.backups = backups
+        self.map = None
+        self._open()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.capacity * RECORD.size:
+                os.ftruncate(fd, self.capacity * RECORD.size)
+            self.map = mmap.mmap(fd, self.capacity * RECORD.size)
+        finally:
+            os.close(fd)
+        self.count = used(self.map, self.capacity)
+
+    def _rotate(self):
+        self.map.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.unlink(self.path)
+        self._open()
+
+    def append(self, record):
+        if self.count == self.capacity:
+            self._rotate()
+        self.map[self.count * RECORD.size : (self.count + 1) * RECORD.size] = record
+        self.count += 1
+
+    def open_backups(self):
+        """The backups, oldest first; open files stay valid across a rotation,
+        and backups are never written to, so they can be read without a lock."""
+        streams = []
+        for index in range(self.backups, 0, -1):
+            try:
+                streams.append(open(f"{self.path}.{index}", "rb"))
+            except FileNotFoundError:
+                pass
+        return streams
+
+
+class Journal:
+    """Lifecycle events as fixed-size records in a memory ring and, when
+    TASKMASTER_JOURNAL_FILE is set, in an mmap'd file."""
+
+    def __init__(self, size=settings.JOURNAL_SIZE, path=settings.JOURNAL_FILE):
+        self.capacity = max(size, 1)
+        self.ring = bytearray(self.capacity * RECORD.size)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.file = None
+        if path:
+            try:
+                self.file = JournalFile(path, settings.JOURNAL_FILE_SIZE, settings.JOURNAL_BACKUPS)
+            except OSError as e:
+                log.log(f"cannot open journal file {path}: {e}")
+
+    def record(self, event, program, instance=0, pid=0, code=0, value=0.0):
+        record = RECORD.pack(time.time(), program.encode()[:32], event, instance, pid, code, value)
+        with self.lock:
+            offset = self.count % self.capacity * RECORD.size
+            self.ring[offset : offset + RECORD.size] = record
+            self.count += 1
+            if self.file is not None:
+                try:
+                    self.file.append(record)
+                except OSError as e:
+                    log.log(f"journal file disabled: {e}")
+                    self.file = None
+
+    def _ring(self):
+        """The ring's records, oldest first."""
+        if self.count <= self.capacity:
+            return bytes(self.ring[: self.count * RECORD.size])
+        split = self.count % self.capacity * RECORD.size
+        return bytes(self.ring[split:] + self.ring[:split])
+
+    def history(self, programs, since=0):
+        names = {name.encode()[:32] for name in programs}
+        backups = []
+        # only copies are taken under the lock, which record() waits for
+        with self.lock:
+            if self.file is not None:
+                backups = self.file.open_backups()
+                data = self.file.map[: self.file.count * RECORD.size]
+            else:
+                data = self._ring()
+        records = []
+        for stream in backups:
+            with stream:
+                backup = stream.read()
+            records.extend(scan(backup, used(backup, len(backup) // RECORD.size), since))
+        records.extend(scan(data, len(data) // RECORD.size, since))
+        return [decode(fields) for fields in records if fields[1].rstrip(b"\0") in names]
+
+
+journal = Journal()
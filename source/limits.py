@@ -0,0 +1,110 @@
+import os
+import platform
+import resource
+from log import logger as log
+import settings
+
+RLIMITS = {
+    "rlimit_nofile": resource.RLIMIT_NOFILE,
+    "rlimit_as": resource.RLIMIT_AS,
+    "rlimit_nproc": resource.RLIMIT_NPROC,
+    "rlimit_core": resource.RLIMIT_CORE,
+}
+
+
+def apply_rlimits(rlimits):
+    """Runs in the child before exec (and before privileges are dropped)."""
+    for limit, value in rlimits:
+        resource.setrlimit(limit, (value, value))
+
+
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_SET = {"x86_64": 251, "i686": 289, "aarch64": 30, "armv7l": 314}
+
+
+def parse_ionice(value):
+    """`class[:level]`, e.g. `idle` or `best-effort:7`, to an ioprio value."""
+    name, _, level = str(value).partition(":")
+    if name not in IOPRIO_CLASSES:
+        raise ValueError(f"ionice class should be one of {', '.join(IOPRIO_CLASSES)}")
+    level = int(level or 4) if name != "idle" else 0
+    if not 0 <= level <= 7:
+        raise ValueError("ionice level should be between 0 and 7")
+    return IOPRIO_CLASSES[name] << 13 | level
+
+
+def ioprio_setter(ioprio):
+    """Resolved in the parent so the child only makes the syscall."""
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None:
+        log.log(f"ionice is not supported on {platform.machine()}, ignoring it")
+        return None
+    import ctypes
+
+    syscall = ctypes.CDLL(None, use_errno=True).syscall
+    # IOPRIO_WHO_PROCESS, the calling process
+    return lambda: syscall(number, 1, 0, ioprio)
+
+
+def cgroup_v2_available():
+    root = os.path.dirname(settings.CGROUP_ROOT.rstrip("/"))
+    return os.path.exists(os.path.join(root, "cgroup.controllers")) and os.access(root, os.W_OK)
+
+
+class CGroup:
+    """A cgroup v2 group per program under TASKMASTER_CGROUP_ROOT."""
+
+    CONTROLLERS = ("memory", "cpu", "pids")
+
+    def __init__(self, name, limits):
+        self.path = os.path.join(settings.CGROUP_ROOT, name)
+        self.limits = limits
+        self.ready = False
+        self.failed = False
+
+    def _write(self, name, value, directory=None):
+        with open(os.path.join(directory or self.path, name), "w") as stream:
+            stream.write(value)
+
+    def _enable_controllers(self, directory):
+        for controller in self.CONTROLLERS:
+            try:
+                self._write("cgroup.subtree_control", f"+{controller}", directory)
+            except OSError:
+                pass
+
+    def ensure(self):
+        """Creates the group and writes its limits; False if cgroup v2 is unusable."""
+        if self.ready or self.failed:
+            return self.ready
+        self.failed = True
+        if not cgroup_v2_available():
+            log.log(f"cgroup v2 not writable, ignoring cgroup limits for {os.path.basename(self.path)}")
+            return False
+        try:
+            self._enable_controllers(os.path.dirname(settings.CGROUP_ROOT.rstrip("/")))
+            os.makedirs(self.path, exist_ok=True)
+            self._enable_controllers(settings.CGROUP_ROOT)
+            for name, value in self.limits.items():
+                self._write(name, value)
+        except OSError as e:
+            log.log(f"cannot set up cgroup {self.path}: {e}")
+            return False
+        self.ready = True
+        self.failed = False
+        return True
+
+    def join(self):
+        """Runs in the child before exec."""
+        self._write("cgroup.procs", "0")
+
+    def oom_kills(self):
+        try:
+            with open(os.path.join(self.path, "memory.events")) as stream:
+                for line in stream:
+                    key, _, value = line.partition(" ")
+                    if key == "oom_kill":
+                        return int(value)
+        except (OSError, ValueError):
+            pass
+        return 0
@@ -0,0 +1,115 @@
+import os
+import socket
+import threading
+from log import logger as log
+
+
+def parse_address(address):
+    """`unix:/path`, `tcp://host:port`, `host:port` or `[v6]:port`."""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:") :]
+    if address.startswith("tcp://"):
+        address = address[len("tcp://") :]
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise ValueError(f"invalid listen address {address}")
+    host = host.strip("[]") or "0.0.0.0"
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    return family, (host, int(port))
+
+
+def bind(address, backlog=socket.SOMAXCONN):
+    family, target = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family == socket.AF_UNIX:
+            if os.path.exists(target):
+                os.unlink(target)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(target)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    sock.set_inheritable(True)
+    return sock
+
+
+def pidfd_getfd(pidfd, fd):
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    # same syscall number on every architecture
+    copy = libc.syscall(438, pidfd, fd, 0)
+    if copy < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return copy
+
+
+class Listeners:
+    """Sockets bound once by taskmaster and shared by every instance that lists
+    them. They stay open across restarts and reloads, so connections wait in
+    the backlog instead of being refused."""
+
+    def __init__(self):
+        self.sockets = {}
+        self.lock = threading.Lock()
+
+    def get(self, address):
+        with self.lock:
+            sock = self.sockets.get(address)
+            if sock is None:
+                sock = self.sockets[address] = bind(address)
+                log.log(f"listening on {address} [fd:{sock.fileno()}]")
+            return sock
+
+    def adopt(self, address, fd):
+        """Take back a listener left open across a re-exec."""
+        with self.lock:
+            self.sockets[address] = socket.socket(fileno=fd)
+
+    def recover(self, address, pid, fd):
+        """Copy a listener out of a child that inherited it as fd (pidfd_getfd)."""
+        with self.lock:
+            if address in self.sockets:
+                return
+            pidfd = os.pidfd_open(pid)
+            try:
+                copy = pidfd_getfd(pidfd, fd)
+            finally:
+                os.close(pidfd)
+            sock = socket.socket(fileno=copy)
+            if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+                sock.close()
+                raise OSError(f"fd {fd} of pid {pid} is not a listening socket")
+            sock.set_inheritable(True)
+            self.sockets[address] = sock
+            log.log(f"recovered listener {address} from [pid:{pid}]")
+
+    def fds(self):
+        with self.lock:
+            return {address: sock.fileno() for address, sock in self.sockets.items()}
+
+    def retain(self, addresses):
+        """Close the listeners no program refers to anymore."""
+        with self.lock:
+            for address in set(self.sockets) - set(addresses):
+                self._close(address)
+
+    def close(self):
+        with self.lock:
+            for address in list(self.sockets):
+                self._close(address)
+
+    def _close(self, address):
+        sock = self.sockets.pop(address)
+        sock.close()
+        family, target = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(target):
+            os.unlink(target)
+        log.log(f"closed listener {address}")
+
+
+listeners = Listeners()
@@ -1,17 +1,79 @@
+import collections
+import json
 import syslog
+import threading
+import time
+import settings
+
 
 class Logger:
+    """Queues messages for a background thread so logging never blocks the
+    caller; when the queue is full the oldest messages are dropped and counted."""
+
     _instance = None
 
     def __new__(cls, log_identifier="Taskmaster"):
         if cls._instance is None:
             cls._instance = super(Logger, cls).__new__(cls)
             cls._instance.log_identifier = log_identifier
+            cls._instance.pending = collections.deque(maxlen=settings.LOG_QUEUE_SIZE)
+            cls._instance.ready = threading.Condition()
+            cls._instance.dropped = 0
+            cls._instance.reported = 0
+            cls._instance.busy = False
+            cls._instance.thread = None
         return cls._instance
 
     def log(self, message, log_level=syslog.LOG_INFO):
+        with self.ready:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append((time.time(), log_level, message))
+            self.ready.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def flush(self, timeout=1):
+        with self.ready:
+            self.ready.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+    def _next_batch(self):
+        with self.ready:
+            self.ready.wait_for(lambda: self.pending)
+            batch = list(self.pending)
+            self.pending.clear()
+            self.busy = True
+            if self.dropped != self.reported:
+                batch.append(
+                    (
+                        time.time(),
+                        syslog.LOG_WARNING,
+                        f"log queue full, {self.dropped - self.reported} messages dropped",
+                    )
+                )
+                self.reported = self.dropped
+        return batch
+
+    def run(self):
         syslog.openlog(self.log_identifier)
-        syslog.syslog(log_level, message)
+        sink = open(settings.LOG_FILE, "a") if settings.LOG_FILE else None
+        while True:
+            batch = self._next_batch()
+            for _, log_level, message in batch:
+                syslog.syslog(log_level, message)
+            if sink:
+                sink.write(
+                    "".join(
+                        json.dumps({"time": timestamp, "level": log_level, "message": message})
+                        + "\n"
+                        for timestamp, log_level, message in batch
+                    )
+                )
+                sink.flush()
+            with self.ready:
+                self.busy = False
+                self.ready.notify_all()
 
 
 logger = Logger()
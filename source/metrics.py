@@ -0,0 +1,213 @@
+import bisect
+import os
+import socketserver
+import threading
+import time
+from log import logger as log
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Histogram:
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = [
+                (labels, (list(counts), total, count))
+                for labels, (counts, total, count) in self.values.items()
+            ]
+        names = self.labels + ("le",)
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket", format_labels(names, labels + (bound,)), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, labels), total
+            yield f"{self.name}_count", format_labels(self.labels, labels), count
+
+
+class Gauge:
+    """Value computed at scrape time by callback(), which yields (labels, value)."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, callback):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.callback = callback
+
+    def samples(self):
+        for labels, value in self.callback():
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.started = time.time()
+        self.gauge(
+            "taskmaster_start_time_seconds",
+            "Start time of the supervisor.",
+            (),
+            lambda: [((), self.started)],
+        )
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels, callback):
+        return self._add(Gauge(name, help, labels, callback))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+spawn_seconds = registry.histogram(
+    "taskmaster_spawn_seconds", "Time spent spawning a process.", ("program",)
+)
+exits = registry.counter(
+    "taskmaster_exits_total", "Process exits by exit code (negative: signal).", ("program", "code")
+)
+unexpected_exits = registry.counter(
+    "taskmaster_unexpected_exits_total", "Exits with a code not in exit_codes.", ("program",)
+)
+restarts = registry.counter("taskmaster_restarts_total", "Automatic restarts scheduled.", ("program",))
+retries_exhausted = registry.counter(
+    "taskmaster_retries_exhausted_total", "Processes given up on after max retries.", ("program",)
+)
+health_restarts = registry.counter(
+    "taskmaster_health_restarts_total", "Instances stopped after failing their health check.", ("program",)
+)
+time_to_ready = registry.histogram(
+    "taskmaster_time_to_ready_seconds", "Time from spawn to passing start_time.", ("program",)
+)
+loop_seconds = registry.histogram(
+    "taskmaster_loop_seconds",
+    "Time the supervisor loop spends handling one wakeup.",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5),
+)
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+def serve(address):
+    """Serve /metrics over HTTP on `unix:/path` or `host:port`."""
+    # http.server pulls in the email package; only import it when serving
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            return str(self.client_address)
+
+        def log_message(self, format, *args):
+            pass
+
+    if address.startswith("unix:"):
+        path = address[len("unix:") :]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixHTTPServer(path, MetricsHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.log(f"metrics available on {address}")
+    return server
+
+
+def write_periodically(path, interval):
+    def run():
+        while True:
+            try:
+                with open(f"{path}.tmp", "w") as stream:
+                    stream.write(registry.render())
+                os.replace(f"{path}.tmp", path)
+            except OSError as e:
+                log.log(f"cannot write metrics to {path}: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=run, daemon=True).start()
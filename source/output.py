@@ -0,0 +1,114 @@
+import os
+import queue
+import threading
+from log import logger as log
+from supervisor import supervisor
+
+
+class RingBuffer:
+    """Keeps only the last `size` bytes written to it."""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray()
+
+    def write(self, chunk):
+        if not self.size:
+            return
+        self.data += chunk
+        if len(self.data) > self.size:
+            del self.data[: len(self.data) - self.size]
+
+    def read(self):
+        return bytes(self.data)
+
+
+class LogWriter:
+    """Single background thread appending captured output to size-rotated files."""
+
+    def __init__(self, max_pending=4096):
+        self.queue = queue.Queue(max_pending)
+        self.files = {}
+        self.dropped = 0
+        self.thread = None
+
+    def write(self, path, chunk, max_bytes, backups):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait((path, chunk, max_bytes, backups))
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self, path):
+        stream = self.files.get(path)
+        if stream is None:
+            stream = self.files[path] = open(path, "ab")
+        return stream
+
+    def _rotate(self, path, backups):
+        self.files.pop(path).close()
+        for index in range(backups - 1, 0, -1):
+            if os.path.exists(f"{path}.{index}"):
+                os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+        if backups:
+            os.replace(path, f"{path}.1")
+        else:
+            os.truncate(path, 0)
+
+    def _write(self, path, chunk, max_bytes, backups):
+        stream = self._open(path)
+        if max_bytes and stream.tell() and stream.tell() + len(chunk) > max_bytes:
+            self._rotate(path, backups)
+            stream = self._open(path)
+        stream.write(chunk)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                try:
+                    self._write(*item)
+                except OSError as e:
+                    log.log(f"cannot write output to {item[0]}: {e}")
+            for stream in self.files.values():
+                stream.flush()
+
+
+writer = LogWriter()
+
+
+class OutputCapture:
+    """Reads a child's stdout/stderr pipe from the supervisor loop into a ring
+    buffer, forwarding it to the log writer unless the target is /dev/null."""
+
+    def __init__(self, path, max_bytes, backups, tail_size):
+        self.path = None if path in (None, os.devnull) else path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.ring = RingBuffer(tail_size)
+
+    def attach(self, pipe):
+        os.set_blocking(pipe.fileno(), False)
+        supervisor.add_reader(pipe.fileno(), lambda: self._read(pipe))
+
+    def _read(self, pipe):
+        try:
+            chunk = os.read(pipe.fileno(), 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+        if not chunk:
+            supervisor.remove_reader(pipe.fileno())
+            pipe.close()
+            return
+        self.ring.write(chunk)
+        if self.path:
+            writer.write(self.path, chunk, self.max_bytes, self.backups)
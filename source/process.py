@@ -1,38 +1,162 @@
-import time
-from enums import AutoRestart
+from enums import AutoRestart, JournalEvent, ProcessState
+from journal import journal
 from log import logger as log
+from supervisor import supervisor
+from output import OutputCapture
+import metrics
 import subprocess
 import datetime
+import functools
+import random
 import signal
+import time
 import os
 
 
+class AdoptedPopen:
+    """Stands in for the Popen of a child started by a previous supervisor."""
+
+    def __init__(self, pid, stdout=None, stderr=None):
+        self.pid = pid
+        self.returncode = None
+        self.stdout = stdout
+        self.stderr = stderr
+
+
 class Process:
 
-    def __init__(self, name, command):
+    __slots__ = (
+        "command",
+        "name",
+        "owner",
+        "retries",
+        "popen",
+        "state",
+        "start",
+        "end",
+        "kill_by_user",
+        "streak",
+        "restart_due",
+        "output",
+        "argv",
+        "stdout",
+        "stderr",
+        "env",
+        "cwd",
+        "umask",
+        "uid",
+        "gid",
+        "child_setup",
+        "instance",
+        "group",
+        "sweep",
+        "pass_fds",
+        "health",
+        "health_failures",
+        "health_due",
+    )
+
+    def __init__(self, name, command, owner=None, instance=0):
         self.command = command
+        self.instance = instance
         self.name = name
+        self.owner = owner
         self.retries = 0
         self.popen = None
-        self.launched = False
+        self.state = ProcessState.IDLE
         self.start = 0
         self.end = None
         self.kill_by_user = False
-        self.starting = False
+        self.streak = 0
+        self.restart_due = None
+        self.output = None
+        self.group = False
+        self.sweep = False
+        self.health = None
+        self.health_failures = 0
+        self.health_due = 0
+
+    @property
+    def launched(self):
+        return self.state != ProcessState.IDLE
+
+    def _set_state(self, state):
+        if self.owner is not None:
+            self.owner.state_changed(self.state, state)
+        self.state = state
 
     def is_running(self):
         if self.popen:
-            return True if self.popen.poll() == None else False
+            return self.popen.returncode is None
         return False
 
-    def demote(self, user_uid, user_gid):
+    def reaped(self, status):
+        if status is None and isinstance(self.popen, AdoptedPopen):
+            # not our child anymore: its exit status is lost
+            log.log(f"[{self.name}] adopted process [pid:{self.popen.pid}] exited, status unknown")
+            self.popen.returncode = -1
+        elif status is None:
+            self.popen.returncode = 0 if self.popen.returncode is None else self.popen.returncode
+        else:
+            self.popen.returncode = os.waitstatus_to_exitcode(status)
+        journal.record(
+            JournalEvent.EXIT,
+            self.name,
+            self.instance,
+            self.popen.pid,
+            self.popen.returncode,
+            time.monotonic() - self.start,
+        )
+        if self.group and self.sweep:
+            self.sweep_group()
+        if self.kill_by_user:
+            self._set_state(ProcessState.STOPPED)
+        elif self.popen.returncode == 0:
+            self._set_state(ProcessState.SUCCESS)
+        else:
+            self._set_state(ProcessState.FAILED)
+
+    def sweep_group(self):
+        """Kill whatever the leader left behind in its process group."""
+        try:
+            os.killpg(self.popen.pid, signal.SIGKILL)
+            log.log(f"[{self.name}] killed orphans of [pid:{self.popen.pid}]")
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def demote(self, user_uid, user_gid, child_setup=None):
         def result():
+            if child_setup is not None:
+                child_setup()
             os.setgid(user_gid)
             os.setuid(user_uid)
 
         return result
 
-    def set_popen_args(self, stdout, stderr, env, workingdir, umask, uid, gid):
+    def set_popen_args(
+        self,
+        stdout,
+        stderr,
+        env,
+        workingdir,
+        umask,
+        uid,
+        gid,
+        log_max_bytes,
+        log_backups,
+        tail_size,
+        argv,
+        child_setup=None,
+        group=False,
+        sweep=False,
+        pass_fds=(),
+    ):
+        if self.output is None:
+            self.output = {
+                "stdout": OutputCapture(stdout, log_max_bytes, log_backups, tail_size),
+                "stderr": OutputCapture(stderr, log_max_bytes, log_backups, tail_size),
+            }
+        self.argv = argv
         self.stdout = stdout
         self.stderr = stderr
         self.env = env
@@ -40,124 +164,169 @@ class Process:
         self.umask = umask
         self.uid = uid
         self.gid = gid
-
-    def open_standard_files(self, file_name):
-        if not file_name:
-            return None
-        try:
-            return open(file_name, "a")
-        except Exception as e:
-            print(
-                f"\033[33mWarning:\033[0m Standard file for {self.name} can't be opened because {e}."
-            )
-            return None
+        self.child_setup = child_setup
+        self.group = group
+        self.sweep = sweep
+        self.pass_fds = pass_fds
 
     def execute(self):
         if self.is_running():
             log.log(f"cannot start an already running process [pid:{self.popen.pid}]")
             return
         try:
-            stdoutf = self.open_standard_files(self.stdout)
-            stderrf = self.open_standard_files(self.stderr)
             self.kill_by_user = False
-            self.start = self.end = datetime.datetime.now()
+            self.restart_due = None
+            self.health, self.health_failures, self.health_due = None, 0, 0
+            self.start = self.end = time.monotonic()
             self.popen = subprocess.Popen(
-                self.command,
-                shell=True,
-                stdout=stdoutf,
-                stderr=stderrf,
+                self.argv or self.command,
+                shell=self.argv is None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
                 stdin=subprocess.DEVNULL,
                 umask=self.umask,
                 env=self.env,
                 cwd=self.cwd,
-                preexec_fn=self.demote(self.uid, self.gid),
+                preexec_fn=self.demote(self.uid, self.gid, self.child_setup),
+                start_new_session=self.group,
+                pass_fds=self.pass_fds,
+            )
+            metrics.spawn_seconds.observe(time.monotonic() - self.start, self.name)
+            journal.record(
+                JournalEvent.SPAWN, self.name, self.instance, self.popen.pid, 0, time.monotonic() - self.start
             )
             if self.is_running():
-                self.launched = True
+                self._set_state(ProcessState.RUNNING)
                 self.end = None
+                self.output["stdout"].attach(self.popen.stdout)
+                self.output["stderr"].attach(self.popen.stderr)
+                supervisor.watch(self)
                 log.log(f"execute({self.command})[pid:{self.popen.pid}]")
         except Exception as E:
             self.popen = None
             log.log(f"[{self.name}] execution failed: {E}")
 
+    def inherit_pipes(self):
+        """Keep the output pipes open across exec; returns their descriptors."""
+        fds = []
+        for pipe in (self.popen.stdout, self.popen.stderr):
+            if pipe is None or pipe.closed:
+                fds.append(None)
+                continue
+            os.set_inheritable(pipe.fileno(), True)
+            fds.append(pipe.fileno())
+        return fds
+
+    def adopt(self, pid, start, retries, streak, fds=(None, None)):
+        """Take over a child that is still running from a previous supervisor."""
+        pipes = [None if fd is None else os.fdopen(fd, "rb", buffering=0) for fd in fds]
+        self.popen = AdoptedPopen(pid, *pipes)
+        self.kill_by_user = False
+        self.restart_due = None
+        self.health, self.health_failures, self.health_due = None, 0, 0
+        self.start, self.end = start, None
+        self.retries, self.streak = retries, streak
+        self._set_state(ProcessState.RUNNING)
+        for stream, pipe in zip(("stdout", "stderr"), pipes):
+            if pipe is not None:
+                os.set_inheritable(pipe.fileno(), False)
+                self.output[stream].attach(pipe)
+        supervisor.watch(self)
+        journal.record(JournalEvent.ADOPT, self.name, self.instance, pid)
+        log.log(f"adopted({self.command})[pid:{pid}]")
+
+    def hold(self, state, stopped, retries, streak):
+        """Take over an instance a previous supervisor had left down."""
+        self.kill_by_user = stopped
+        self.retries, self.streak = retries, streak
+        self._set_state(state)
+
     def exit_status(self):
-        if self.launched:
-            return self.popen.poll()
+        if self.launched and self.popen:
+            return self.popen.returncode
         return None
 
     def elapsed_time(self):
         """Represents the process's time to live"""
         if self.launched and self.is_running():
-            return datetime.datetime.now() - self.start
-        return self.end - self.start
+            return datetime.timedelta(seconds=time.monotonic() - self.start)
+        return datetime.timedelta(seconds=(self.end or time.monotonic()) - self.start)
 
-    def check(self, auto_restart, stop_time, exit_codes, start_time, retries):
+    def check(self, auto_restart, exit_codes, start_time, retries, backoff_initial, backoff_max):
         if self.launched:
             if self.exit_status() != None and self.end == None:
-                self.end = datetime.datetime.now()
+                self.end = time.monotonic()
                 if self.exit_status() not in exit_codes:
+                    metrics.unexpected_exits.inc(self.name)
                     log.log(
                         f"process[pid:{self.popen.pid}] stopped unexpectedly [code:{self.exit_status()}]"
                     )
-            td = datetime.timedelta(seconds=start_time)
-            if datetime.datetime.now() - self.start < td:
-                self.starting = True
-            else:
-                self.starting = False
-        if self.exit_status() is not None:
-            self.ensure_restart(auto_restart, exit_codes, retries, start_time)
-        else:
-            self.ensure_force_kill(stop_time)
+        if self.exit_status() is not None and self.restart_due is None:
+            if self.ensure_restart(auto_restart, exit_codes, retries, start_time):
+                self.schedule_restart(backoff_initial, backoff_max)
+
+    def is_starting(self, start_time):
+        if not self.launched or not self.is_running():
+            return False
+        return time.monotonic() - self.start < start_time
 
     def lived_enough(self, start_time):
         if not self.start or not self.end or not start_time:
             return True
-        td = datetime.timedelta(seconds=start_time)
-        if self.end - self.start <= td:
+        if self.end - self.start <= start_time:
             return False
         return True
 
     def ensure_restart(self, auto_restart, exit_codes, retries, start_time):
+        """Whether the process should be restarted after its exit."""
+        if self.kill_by_user:
+            return False
         if auto_restart == AutoRestart.ALWAYS:
-            return self.execute()
-        if (
-            auto_restart == AutoRestart.NEVER
-            or self.kill_by_user
-            or self.retries > retries
-        ):
-            return
+            return True
+        if auto_restart == AutoRestart.NEVER or self.retries > retries:
+            return False
         if (
             auto_restart == AutoRestart.UNEXPECTED
             and self.exit_status() in exit_codes
             and self.lived_enough(start_time)
         ):
-            return
+            return False
         es = self.exit_status()
         if (es is not None and es not in exit_codes) or not self.lived_enough(start_time):
             self.retries += 1
             if self.retries > retries:
+                metrics.retries_exhausted.inc(self.name)
+                journal.record(JournalEvent.GIVE_UP, self.name, self.instance, self.popen.pid, self.retries)
                 log.log(f"max retries reached [pid:{self.popen.pid}]")
-                return
-        self.execute()
+                return False
+        return True
 
-    def ensure_force_kill(self, stop_time):
-        if self.popen == None:
-            return
-        if self.end:
-            time_diff = datetime.datetime.now() - self.end
-            if time_diff >= datetime.timedelta(seconds=stop_time):
-                self.popen.kill()
+    def schedule_restart(self, backoff_initial, backoff_max):
+        """Queue a restart after an exponential, jittered delay that grows with
+        each restart until the process is promoted (see Program.promote)."""
+        delay = min(backoff_max, backoff_initial * 2 ** min(self.streak, 32))
+        delay *= random.uniform(0.5, 1)
+        self.streak += 1
+        metrics.restarts.inc(self.name)
+        journal.record(JournalEvent.BACKOFF, self.name, self.instance, self.popen.pid, self.streak, delay)
+        self.restart_due = time.monotonic() + delay
+        supervisor.call_at(
+            self.restart_due,
+            self.owner.lock,
+            functools.partial(self.owner.restart_due, self, self.restart_due),
+        )
 
-    def kill(self, stop_signal, killed_by_user=True):
-        self.kill_by_user = killed_by_user
-        if self.is_running():
-            os.kill(self.popen.pid, stop_signal)
-            while self.popen.poll() == None:
-                time.sleep(0.01)
-            self.end = datetime.datetime.now()
-
-    def restart(self):
-        log.log(f"restart process [{self.name}]")
-        self.kill(signal.SIGKILL, False)
-        self.retries = 0
-        self.execute()
+    def send_stop_signal(self, stop_signal):
+        if not self.is_running():
+            return False
+        try:
+            if self.group:
+                os.killpg(self.popen.pid, stop_signal)
+            else:
+                os.kill(self.popen.pid, stop_signal)
+        except ProcessLookupError:
+            pass
+        return True
+
+    def stopped(self):
+        self.end = time.monotonic()
@@ -1,16 +1,46 @@
 from typing import Dict, List, Optional, Any
-from enums import Signals, AutoRestart
+import functools
+from collections import Counter
+from enum import IntEnum
+from enums import Signals, AutoRestart, ShellMode, ProcessState, JournalEvent
+from journal import journal
+from status import board, wall_time
 from process import Process
+from health import Probe
+from config import section_hash
+from listeners import listeners, parse_address
+from limits import RLIMITS, CGroup, apply_rlimits, ioprio_setter, parse_ionice
 from log import logger as log
+from supervisor import supervisor
+import metrics
+import settings
+import threading
+import time
+import shlex
+import shutil
 import grp
 import pwd
 import os
 
 
+SHELL_METACHARACTERS = set("|&;<>()$`*?[]#~{}!\n")
+
+STATE_COLORS = {
+    "stopped": 35,
+    "stopped prematurely": 35,
+    "failed": 31,
+    "starting": 34,
+    "running": 33,
+    "success": 32,
+    "unhealthy": 31,
+}
+
+
 class Program:
 
     name: str = ""
     cmd: str = ""
+    shell: ShellMode = ShellMode.AUTO
     count: int = 1
     uid: int = os.getuid()
     gid: int = os.getgid()
@@ -20,33 +50,147 @@ class Program:
     start_time: int = 0
     retries: int = 0
     stop_signal: Signals = Signals.TERM
-    stop_time: int = 0
+    stop_time: int = 0  # seconds before SIGKILL; 0 waits for the exit
+    stop_as_group: bool = True
+    sweep_orphans: bool = False
+    backoff_initial: float = 0.1
+    backoff_max: float = 30.0
     working_dir: Optional[str] = "./"
     stdout: str = "/dev/null"
     stderr: str = "/dev/null"
     umask: int = 22
+    rlimit_nofile: int = -1
+    rlimit_as: int = -1
+    rlimit_nproc: int = -1
+    rlimit_core: int = -1
+    memory_max: str = ""
+    cpu_max: str = ""
+    pids_max: int = 0
+    cpu_affinity: str = ""
+    nice: int = 0
+    ionice: str = ""
+    log_max_bytes: int = 10 * 1024 * 1024
+    log_backups: int = 5
+    tail_size: int = 64 * 1024
+    priority: int = 999
+    depends_on: List[str] = []
+    start_concurrency: int = 0
+    start_gate: bool = False
     processes: List[Process] = []
     env: Dict[str, str] = {}
+    sockets: Dict[str, str] = {}
+    health_check: Dict[str, Any] = {}
     config: Dict[str, any] = {}
 
-    def __init__(self, name: str, properties: Dict[str, Any]):
+    def __init__(self, name: str, properties: Dict[str, Any], spec: Optional[Dict[str, Any]] = None):
         if not properties:
             raise ValueError("Cannot create program with no properties.")
         self.name = name
         self.processes = []
         self.env = {}
+        self.lock = threading.RLock()
+        self.state_lock = threading.Lock()
+        self.state_counts = Counter()
         self.config = properties
-        self._parse_properties(properties=properties)
+        if spec is None:
+            self._parse_properties(properties=properties)
+        else:
+            self._load_spec(spec)
+        # validated values, cached by ProgramsManager for the next start
+        self.spec = {
+            key: getattr(self, key)
+            for key in properties
+            if key in self.__dict__ and hasattr(Program, key)
+        }
         self.env = self._get_expanded_env()
         if not self.cmd:
             raise ValueError(f"Program {self.name} has no cmd attribute")
+        self.argv = self._command_argv() if spec is None else spec["argv"]
+        self.spec["argv"] = self.argv
+        self.config_hash = ""
+        self.cgroup = self._cgroup()
+        self.child_setup = self._child_setup()
+        self.probe = Probe(self.health_check) if self.health_check else None
         self._create_processes(self.count)
 
+    def _command_argv(self):
+        """Argument vector to exec directly, or None when cmd needs /bin/sh."""
+        if self.shell == ShellMode.ALWAYS:
+            return None
+        if self.shell == ShellMode.AUTO and SHELL_METACHARACTERS.intersection(self.cmd):
+            return None
+        try:
+            argv = shlex.split(self.cmd)
+        except ValueError as e:
+            if self.shell == ShellMode.NEVER:
+                raise ValueError(f"Cannot parse cmd of {self.name} without a shell ({e})")
+            return None
+        if self.shell == ShellMode.AUTO and (
+            not argv
+            or "=" in argv[0]
+            or ("/" not in argv[0] and shutil.which(argv[0], path=self.env.get("PATH")) is None)
+        ):
+            return None
+        return argv
+
+    def _cgroup(self):
+        limits = {"memory.max": self.memory_max, "cpu.max": self.cpu_max}
+        if self.pids_max:
+            limits["pids.max"] = str(self.pids_max)
+        limits = {name: value for name, value in limits.items() if value}
+        return CGroup(self.name, limits) if limits else None
+
+    def _cpu_sets(self):
+        """CPUs for each instance index: a fixed set, or one core each with auto-spread."""
+        if not self.cpu_affinity:
+            return None
+        if self.cpu_affinity == "auto-spread":
+            cores = sorted(os.sched_getaffinity(0))
+            return lambda instance: {cores[instance % len(cores)]}
+        cores = {int(core) for core in self.cpu_affinity.split(",")}
+        return lambda instance: cores
+
+    def _child_setup(self):
+        """Returns the function run in each child before exec, given its instance index."""
+        rlimits = [
+            (limit, getattr(self, name)) for name, limit in RLIMITS.items() if getattr(self, name) >= 0
+        ]
+        cgroup = self.cgroup
+        cpu_sets = self._cpu_sets()
+        nice = self.nice
+        set_ioprio = ioprio_setter(parse_ionice(self.ionice)) if self.ionice else None
+
+        def setup(instance):
+            if cgroup is not None and cgroup.ready:
+                cgroup.join()
+            apply_rlimits(rlimits)
+            if cpu_sets is not None:
+                os.sched_setaffinity(0, cpu_sets(instance))
+            if nice:
+                os.setpriority(os.PRIO_PROCESS, 0, nice)
+            if set_ioprio is not None:
+                set_ioprio()
+
+        return setup
+
+    def oom_kills(self):
+        if self.cgroup is None or not self.cgroup.ready:
+            return 0
+        return self.cgroup.oom_kills()
+
     def _create_processes(self, count):
         procces_list = []
-        for _ in range(0, count):
-            procces_list.append(Process(self.name, self.cmd))
+        for instance in range(0, count):
+            procces_list.append(Process(self.name, self.cmd, self, instance))
         self.processes = procces_list
+        with self.state_lock:
+            self.state_counts = Counter({ProcessState.IDLE: count})
+
+    def state_changed(self, old, new):
+        with self.state_lock:
+            self.state_counts[old] -= 1
+            self.state_counts[new] += 1
+        board.changed()
 
     def _validate_type(self, value, attribute_name, attribute_type):
         if isinstance(value, attribute_type):
@@ -64,6 +208,15 @@ class Program:
             value = self._validate_values(k, v)
             self._validate_type(value, k, type(program_attribute))
 
+    def _load_spec(self, spec):
+        for key, value in spec.items():
+            if key == "argv":
+                continue
+            default = getattr(Program, key)
+            if isinstance(default, IntEnum):
+                value = type(default)(value)
+            setattr(self, key, value)
+
     def _get_expanded_env(self):
         new_env = os.environ
         for k, v in self.env.items():
@@ -95,8 +248,29 @@ class Program:
             return self._validate_auto_restart(value)
         if name == "stop_signal":
             return self._validate_stop_signal(value)
+        if name == "shell":
+            return ShellMode.from_value(value)
         if name == "env":
             return self._validate_env(value)
+        if name == "depends_on":
+            return self._validate_depends_on(value)
+        if name == "sockets":
+            return self._validate_sockets(value)
+        if name == "health_check":
+            return Probe.validate(value)
+        if name in ("backoff_initial", "backoff_max"):
+            return self._validate_seconds(name, value)
+        if name == "memory_max":
+            return self._validate_memory_max(value)
+        if name == "cpu_max":
+            return self._validate_cpu_max(value)
+        if name == "cpu_affinity":
+            return self._validate_cpu_affinity(value)
+        if name == "nice":
+            return self._validate_nice(value)
+        if name == "ionice":
+            parse_ionice(value)
+            return str(value)
         if name == "uid":
             return self._validate_uid(value)
         if name == "gid":
@@ -110,8 +284,67 @@ class Program:
         if isinstance(value, int):
             if value < 0:
                 raise ValueError(f"The {name} cannot be negative.")
-            if name == "count" and value > 100:
-                raise ValueError(f"Number of processes is limited to 100")
+            if name == "count" and value > settings.MAX_PROCESSES:
+                raise ValueError(f"Number of processes is limited to {settings.MAX_PROCESSES}")
+        return value
+
+    def _validate_depends_on(self, value):
+        if isinstance(value, str):
+            value = [value]
+        if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+            raise ValueError("depends_on should be a program name or a list of program names")
+        return value
+
+    def _validate_sockets(self, value):
+        if isinstance(value, list):
+            value = {f"socket{index}": address for index, address in enumerate(value)}
+        if not isinstance(value, dict) or not all(
+            isinstance(name, str) and isinstance(address, str) for name, address in value.items()
+        ):
+            raise ValueError("sockets should map names to listen addresses")
+        for address in value.values():
+            parse_address(address)
+        return value
+
+    def _validate_seconds(self, name, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"The {name} should be a non-negative number of seconds.")
+        return float(value)
+
+    def _validate_memory_max(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError("memory_max should be a number of bytes (K/M/G suffixes allowed) or max.")
+        return str(value)
+
+    def _validate_cpu_max(self, value):
+        """A number of CPUs (e.g. 0.5) or a raw cpu.max value ("50000 100000")."""
+        if isinstance(value, bool):
+            raise ValueError("cpu_max should be a number of CPUs or a cpu.max value.")
+        if isinstance(value, (int, float)):
+            if value <= 0:
+                raise ValueError("cpu_max should be positive.")
+            return f"{int(value * 100000)} 100000"
+        return str(value)
+
+    def _validate_cpu_affinity(self, value):
+        if value == "auto-spread":
+            return value
+        if isinstance(value, int) and not isinstance(value, bool):
+            value = [value]
+        if isinstance(value, str):
+            value = value.split(",")
+        try:
+            cores = [int(core) for core in value]
+        except (TypeError, ValueError):
+            raise ValueError("cpu_affinity should be a list of CPUs or auto-spread.")
+        available = os.sched_getaffinity(0)
+        if not cores or any(core not in available for core in cores):
+            raise ValueError(f"cpu_affinity should only use available CPUs {sorted(available)}.")
+        return ",".join(str(core) for core in cores)
+
+    def _validate_nice(self, value):
+        if isinstance(value, bool) or not isinstance(value, int) or not -20 <= value <= 19:
+            raise ValueError("nice should be between -20 and 19.")
         return value
 
     def _validate_umask(self, value):
@@ -158,108 +391,255 @@ class Program:
 
     def _validate_stdfile(self, value):
         try:
-            file = open(value, 'w')
-            return value
+            # append, never truncate: the output writer keeps adding to it
+            with open(value, "a"):
+                return value
         except Exception as E:
             print(f"\033[33mWarning:\033[0m output to file [{value}] will be discarded.")
 
-    def execute_processes(self, processes):
+    def listen_fds(self):
+        """Descriptors of the program's shared listeners, bound on first use."""
+        return {name: listeners.get(address).fileno() for name, address in self.sockets.items()}
+
+    def prepare(self, processes):
+        """Hands each process its spawn settings; False if the sockets can't be bound."""
+        if self.cgroup is not None:
+            self.cgroup.ensure()
+        try:
+            fds = self.listen_fds()
+        except OSError as e:
+            log.log(f"[{self.name}] cannot bind its sockets: {e}")
+            return False
+        env = dict(self.env)
+        if fds:
+            env["TASKMASTER_LISTEN_FDS"] = ",".join(f"{name}={fd}" for name, fd in fds.items())
         for process in processes:
             process.set_popen_args(
                 stdout=self.stdout,
                 stderr=self.stderr,
-                env=self.env,
+                env=dict(env, TASKMASTER_INSTANCE=str(process.instance)),
                 umask=self.umask,
                 workingdir=self.working_dir,
                 uid=self.uid,
                 gid=self.gid,
+                log_max_bytes=self.log_max_bytes,
+                log_backups=self.log_backups,
+                tail_size=self.tail_size,
+                argv=self.argv,
+                child_setup=functools.partial(self.child_setup, process.instance),
+                group=self.stop_as_group,
+                sweep=self.sweep_orphans,
+                pass_fds=tuple(fds.values()),
             )
-            process.execute()
-
-    def execute(self):
-        self.execute_processes(self.processes)
+        return True
 
-    def status(self):
-        if not self.processes:
-            print(f"\033[33mWarning:\033[0m no process found")
+    def execute_processes(self, processes):
+        if not self.prepare(processes):
             return
-        r, o, k, l, s = 0, 0, 0, 0, 0
-        for process in self.processes:
-            if process.launched:
-                l += 1
+        for process in processes:
+            process.execute()
             if process.is_running():
-                r += 1
-            if process.kill_by_user:
-                s += 1
-            elif process.exit_status() is not None:
-                o = o + 1 if process.exit_status() == 0 else o
-                k = k + 1 if process.exit_status() else k
-        print(
-            f"program: {self.name}\n↳ launched: {l}, running: {r}, success: {o}, failed: {k}, stopped: {s}"
+                self._schedule_promote(process)
+
+    def _schedule_promote(self, process):
+        supervisor.call_at(
+            process.start + max(self.start_time, 1),
+            self.lock,
+            functools.partial(self.promote, process, process.popen),
         )
-        return len(self.processes)
 
-    def full_status(self):
-        if not self.processes:
-            print(f"\033[33mWarning:\033[0m no processes found")
+    def adopt(self, entry, fds):
+        """Re-attach a child described by a state file entry; False if its instance is taken."""
+        if entry["instance"] >= len(self.processes):
+            return False
+        process = self.processes[entry["instance"]]
+        if process.is_running() or not self.prepare([process]):
+            return False
+        process.adopt(entry["pid"], entry["start"], entry["retries"], entry["streak"], fds)
+        self._schedule_promote(process)
+        return True
+
+    def hold(self, entry):
+        """Restore an instance a previous supervisor had left down (see
+        StateFile); returns its process, or None if the instance is gone."""
+        if entry["instance"] >= len(self.processes):
+            return None
+        process = self.processes[entry["instance"]]
+        process.hold(ProcessState[entry["state"]], entry["stopped"], entry["retries"], entry["streak"])
+        return process
+
+    def promote(self, process, popen):
+        """The process outlived start_time: it counts as started and its
+        restart backoff starts over."""
+        if process.popen is popen and process.is_running():
+            process.streak = 0
+            metrics.time_to_ready.observe(time.monotonic() - process.start, self.name)
+            board.changed()
+
+    def readiness(self, process, popen):
+        """True once the instance started from popen has lived start_time
+        (at least a second), False if it is gone, None while undecided."""
+        if process.popen is not popen or not process.is_running():
+            return False
+        if time.monotonic() - process.start < max(self.start_time, 1):
+            return None
+        if self.probe is not None and process.health is not True:
+            return None
+        return True
+
+    def health_result(self, process, popen, healthy):
+        if process.popen is not popen or not process.is_running():
             return
-        self.status()
-        for process in self.processes:
-            process.check(self.auto_restart, self.stop_time, self.exit_codes, self.start_time, self.retries)
-            if process.launched:
-                print(f"↳ {hex(id(process))} [pid:{process.popen.pid}]", end="")
-                if process.kill_by_user:
-                    print(f" \033[35mstopped\033[0m ({process.elapsed_time()})", end="")
-                elif process.lived_enough(self.start_time) == False:
-                    print(f" \033[35mstopped prematurely\033[0m ({process.elapsed_time()})", end="")
-                elif not process.is_running() and process.exit_status() not in self.exit_codes:
-                    exit_status = process.exit_status()
-                    print(
-                        f" \033[31mfailed\033[0m  ({process.elapsed_time()}) [code:{exit_status}]",
-                        end="",
-                    )
-                elif process.starting:
-                    print(f" \033[34mstarting\033[0m ({process.elapsed_time()})", end="")
-                elif process.is_running():
-                    print(f" \033[33mrunning\033[0m ({process.elapsed_time()})", end="")
-                elif process.exit_status() in self.exit_codes:
-                    print(
-                        f" \033[32msuccess\033[0m ({process.elapsed_time()}) [code:{process.exit_status()}]",
-                        end="",
-                    )
-                print()
+        if healthy:
+            if process.health is False:
+                log.log(f"[{self.name}] process [pid:{popen.pid}] is healthy again")
+            if process.health is not True:
+                board.changed()
+            process.health, process.health_failures = True, 0
+            return
+        if process.health is not False:
+            board.changed()
+        process.health = False
+        process.health_failures += 1
+        if process.health_failures < self.probe.failures:
+            return
+        if process.health_failures == self.probe.failures:
+            log.log(
+                f"[{self.name}] process [pid:{popen.pid}] failed {self.probe.failures} health checks, stopping it"
+            )
+            metrics.health_restarts.inc(self.name)
+            journal.record(JournalEvent.UNHEALTHY, self.name, process.instance, popen.pid, process.health_failures)
+        # repeated while it keeps failing; a hung process is killed even with stop_time 0
+        supervisor.terminate(process, self.stop_signal, self.stop_time or settings.HEALTH_STOP_TIME, by_user=False)
+
+    def restart_due(self, process, due):
+        if process.owner is not self or process.restart_due != due:
+            return
+        process.restart_due = None
+        if not process.is_running() and not process.kill_by_user:
+            journal.record(JournalEvent.RESTART, self.name, process.instance, process.popen.pid)
+            self.execute_processes([process])
+
+    def execute(self):
+        self.execute_processes(self.processes)
+
+    def counters(self):
+        with self.state_lock:
+            counts = dict(self.state_counts)
+        return {
+            "launched": len(self.processes) - counts.get(ProcessState.IDLE, 0),
+            "running": counts.get(ProcessState.RUNNING, 0),
+            "success": counts.get(ProcessState.SUCCESS, 0),
+            "failed": counts.get(ProcessState.FAILED, 0),
+            "stopped": counts.get(ProcessState.STOPPED, 0),
+        }
+
+    def process_state(self, process):
+        if process.kill_by_user:
+            return "stopped"
+        if process.lived_enough(self.start_time) == False:
+            return "stopped prematurely"
+        if not process.is_running() and process.exit_status() not in self.exit_codes:
+            return "failed"
+        if process.is_starting(self.start_time):
+            return "starting"
+        if process.is_running():
+            return "unhealthy" if process.health is False else "running"
+        return "success"
+
+    def snapshot(self, full=False):
+        """This program's entry in the published status (see status.StatusBoard);
+        the per-process entries only with `full`."""
+        entry = self.counters()
+        if self.cgroup is not None:
+            entry["oom_kills"] = self.oom_kills()
+        if not full:
+            return entry
+        processes = []
+        for process in list(self.processes):
+            popen = process.popen
+            if not process.launched or popen is None:
+                continue
+            processes.append(
+                {
+                    "id": hex(id(process)),
+                    "pid": popen.pid,
+                    "state": self.process_state(process),
+                    "started": wall_time(process.start),
+                    "ended": None if process.end is None else wall_time(process.end),
+                    "code": process.exit_status(),
+                    "health": process.health,
+                }
+            )
+        entry["processes"] = tuple(processes)
+        return entry
+
+    def tail(self, stream="stdout"):
+        return [
+            (process.popen.pid, process.output[stream].ring.read())
+            for process in self.processes
+            if process.launched and process.popen is not None
+        ]
 
     def restart(self):
         log.log(f"restart program [{self.name}]")
+        supervisor.stop(
+            [(process, Signals.KILL, 0) for process in self.processes if process.is_running()],
+            by_user=False,
+        )
         for process in self.processes:
-            process.restart()
+            process.kill_by_user = False
+            process.retries = 0
+        self.execute()
 
-    def kill(self):
+    def stop_targets(self):
+        """Running processes to signal; the others waiting out a backoff are
+        marked stopped too, so their pending restart does nothing."""
         for process in self.processes:
-            if process.is_running():
-                process.kill(self.stop_signal)
+            process.kill_by_user = True
+            process.restart_due = None
+        board.changed()
+        return [
+            (process, self.stop_signal, self.stop_time)
+            for process in self.processes
+            if process.is_running()
+        ]
+
+    def kill(self):
+        supervisor.stop(self.stop_targets())
+
+    def detach(self):
+        """Called once the program is replaced or removed: late exits and timers
+        of its processes no longer reach it."""
+        with self.state_lock:
+            for process in self.processes:
+                process.owner = None
 
     def check(self):
         for process in self.processes:
-            process.check(
-                auto_restart=self.auto_restart,
-                stop_time=self.stop_time,
-                exit_codes=self.exit_codes,
-                start_time=self.start_time,
-                retries=self.retries,
-            )
+            self.check_process(process)
+
+    def check_process(self, process):
+        if process.owner is not self:
+            return
+        process.check(
+            auto_restart=self.auto_restart,
+            exit_codes=self.exit_codes,
+            start_time=self.start_time,
+            retries=self.retries,
+            backoff_initial=self.backoff_initial,
+            backoff_max=self.backoff_max,
+        )
 
     def reload_has_substantive_change(self, new_config):
+        """Whether anything but count was added, changed or removed."""
         if not new_config:
             raise ValueError("Cannot create program with no properties.")
-        return any(
-            [
-                getattr(self, k, None) is not None
-                and (k not in self.config.keys() or self.config[k] != new_config[k])
-                for k, _ in new_config.items()
-                if k != "count"
-            ]
-        )
+        return self._shape_hash(self.config) != self._shape_hash(new_config)
+
+    @staticmethod
+    def _shape_hash(config):
+        return section_hash({key: value for key, value in config.items() if key != "count"})
 
     def assign_count(self, count):
         self.count = self._validate_values("count", count)
@@ -270,13 +650,19 @@ class Program:
             return
         if len(self.processes) < self.count:
             for _ in range(0, (self.count - len(self.processes))):
-                newp = Process(self.name, self.cmd)
+                newp = Process(self.name, self.cmd, self, len(self.processes))
                 self.processes.append(newp)
                 newps.append(newp)
+            with self.state_lock:
+                self.state_counts[ProcessState.IDLE] += len(newps)
         else:
-            del self.processes
-            self._create_processes(self.count)
-            self.execute()
+            surplus = self.processes[self.count :]
+            supervisor.stop([(process, self.stop_signal, self.stop_time) for process in surplus])
+            del self.processes[self.count :]
+            with self.state_lock:
+                for process in surplus:
+                    process.owner = None
+                    self.state_counts[process.state] -= 1
             return
 
         if self.auto_start:
@@ -1,65 +1,205 @@
 from ast import Dict
-import yaml
+from contextlib import ExitStack, contextmanager
+import threading
 import os
+import signal
 import sys
+from config import CompiledCache, ConfigCache
 from program import Program
-
-
-def load_config_file():
-    files = sys.argv[1:]
-    full_stream = []
-    if len(files) == 0:
-        print("Usage: ./taskmaster conf.yaml")
-        exit(os.EX_OK)
-    try:
-        for file in files:
-            with open(file, "r") as stream:
-                full_stream.append(stream.read())
-        if not full_stream:
-            return {}  
-        load_iter = yaml.safe_load_all("\n---\n".join(full_stream))
-        full_load = next(load_iter)
-        for itr in load_iter:
-            full_load.update(itr)
-        return full_load
-    except Exception as E:
-        raise ValueError(f"Can't parse configuration file.")
+from scheduler import Launcher
+from sampler import Sampler
+from health import HealthChecker
+from supervisor import supervisor
+from listeners import listeners
+from state import StateFile, proc_start
+from status import board
+from log import logger as log
+import settings
 
 
 class ProgramsManager:
 
-    def __init__(self):
+    def __init__(self, files=None):
+        self.files = sys.argv[1:] if files is None else files
+        self.config = ConfigCache(self.files, CompiledCache(settings.CONFIG_CACHE, self._cache_context()))
         self.programs_dict: Dict[str, Program] = {}
         self.names = set()
+        self.lock = threading.RLock()
+        self.reloading = threading.Lock()
+        self.sampler = Sampler(self)
+        self.health = HealthChecker(self)
+        self.state = StateFile()
+        self.held = set()
 
     def programs(self):
-        return self.programs_dict.values()
+        with self.lock:
+            return list(self.programs_dict.values())
+
+    def find(self, names):
+        with self.lock:
+            return [
+                self.programs_dict[name]
+                for name in dict.fromkeys(names)
+                if name in self.programs_dict
+            ]
+
+    @contextmanager
+    def locked(self, programs):
+        """Hold the locks of several programs, always acquired in name order."""
+        programs = sorted(programs, key=lambda program: program.name)
+        with ExitStack() as stack:
+            for program in programs:
+                stack.enter_context(program.lock)
+            yield programs
+
+    def load_config(self):
+        if len(self.files) == 0:
+            print("Usage: ./taskmaster conf.yaml")
+            exit(os.EX_OK)
+        return self.config.load()
+
+    def _cache_context(self):
+        """What cached specs depend on besides the config itself."""
+        code = [os.stat(sys.modules[module].__file__).st_mtime_ns for module in ("program", "config")]
+        return [code, settings.MAX_PROCESSES, os.getuid(), os.getgid(), os.environ.get("PATH")]
+
+    def _new_program(self, name, properties, config_hash):
+        spec = self.config.compiled.spec(config_hash) if self.config.compiled else None
+        program = Program(name, properties, spec)
+        program.config_hash = config_hash
+        if spec is None and self.config.compiled:
+            self.config.compiled.put_spec(config_hash, program.spec)
+        return program
 
     def load(self):
-        confs = load_config_file()
+        confs, hashes, _ = self.load_config()
         if not confs:
             print("\033[31m Error:\033[0m empty config")
             exit(os.EX_OK)
         for name, properties in confs.items():
-            new_program = Program(name, properties)
+            new_program = self._new_program(name, properties, hashes[name])
             self.programs_dict.update({new_program.name: new_program})
+        self.config.save_compiled()
+        board.changed()
+
+    def adopt(self):
+        """Take over the children listed in the state file that are still alive and
+        whose program config is unchanged; stale ones are asked to stop. Instances
+        recorded as held (stopped, or done restarting) are not launched again.
+
+        After a crash the children are no longer ours: without pidfd their exit
+        could not be seen, so they are all stopped and started afresh instead."""
+        state = self.state.load()
+        if state is None:
+            return
+        foreign = not state["inherited"] and not supervisor.use_pidfd
+        if foreign:
+            log.log("no pidfd support: cannot watch children of a previous taskmaster, restarting them")
+        if state["inherited"]:
+            for address, fd in state["listeners"].items():
+                listeners.adopt(address, fd)
+        adopted = 0
+        for name, entry in state["programs"].items():
+            program = self.programs_dict.get(name)
+            if program is not None and program.config_hash == entry["hash"]:
+                with program.lock:
+                    self.held.update(program.hold(held) for held in entry.get("held", ()))
+                self.held.discard(None)
+            for process in entry["processes"]:
+                fds = process.get("fds", (None, None))
+                if process["proc_start"] is None or proc_start(process["pid"]) != process["proc_start"]:
+                    self._close(fds)
+                    continue
+                if not foreign and program is not None and program.config_hash == entry["hash"]:
+                    if not state["inherited"]:
+                        self._recover_listeners(program, process["pid"], state["listeners"])
+                    with program.lock:
+                        if program.adopt(process, fds):
+                            adopted += 1
+                            continue
+                log.log(f"[{name}] stopping stale process [pid:{process['pid']}]")
+                self._close(fds)
+                try:
+                    if os.getpgid(process["pid"]) == process["pid"]:
+                        os.killpg(process["pid"], signal.SIGTERM)
+                    else:
+                        os.kill(process["pid"], signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        log.log(f"adopted {adopted} running processes from {self.state.path}")
+
+    def _close(self, fds):
+        for fd in fds:
+            if fd is not None:
+                os.close(fd)
+
+    def _recover_listeners(self, program, pid, fds):
+        for address in program.sockets.values():
+            if address in fds:
+                try:
+                    listeners.recover(address, pid, fds[address])
+                except OSError as e:
+                    log.log(f"[{program.name}] cannot recover listener {address}: {e}")
+
+    def listener_fds(self):
+        return listeners.fds()
+
+    def reexec(self):
+        """Replace the supervisor with a fresh copy of itself; the children keep
+        running and are adopted by the new image."""
+        log.log("re-executing taskmaster")
+        self.state.save(self, inherit=True)
+        log.flush()
+        self.state.lock.acquire()
+        os.environ["TASKMASTER_REEXEC"] = "1"
+        os.execv(sys.executable, [sys.executable] + sys.argv)
 
     def reload(self):
-        confs = load_config_file()
+        with self.reloading:
+            confs, hashes, changed = self.load_config()
+            if not changed:
+                return
+            # the manager lock only covers swapping entries: stopping the old
+            # programs waits for their exit and must not block status or stop
+            with self.lock:
+                retired, resized, started = self._reload(dict(confs), hashes)
+                self.config.save_compiled()
+            self.stop(retired)
+            for program in retired:
+                program.detach()
+            for program, config, config_hash in resized:
+                with program.lock:
+                    program.assign_count(config.get("count", Program.count))
+                    program.reload()
+                    program.config, program.config_hash = config, config_hash
+            for program in started:
+                with program.lock:
+                    program.execute()
+            listeners.retain(
+                address for program in self.programs() for address in program.sockets.values()
+            )
+        board.changed()
+
+    def _reload(self, confs, hashes):
+        """Swaps in the new programs; returns the programs to stop, those to
+        resize in place and those to start."""
+        retired, resized, started = [], [], []
         for prog_name in list(self.programs_dict.keys()):
             if prog_name in confs:
                 config = confs[prog_name]
+                program = self.programs_dict[prog_name]
+                if program.config_hash == hashes[prog_name]:
+                    del confs[prog_name]
+                    continue
                 try:
-                    if self.programs_dict[prog_name].reload_has_substantive_change(config):
-                        new_program = Program(prog_name, config)
-                        self.programs_dict[prog_name].kill()
-                        del self.programs_dict[prog_name]
+                    if program.reload_has_substantive_change(config):
+                        new_program = self._new_program(prog_name, config, hashes[prog_name])
+                        retired.append(program)
                         self.programs_dict[prog_name] = new_program
-                        if self.programs_dict[prog_name].auto_start:
-                            self.programs_dict[prog_name].execute()
+                        if new_program.auto_start:
+                            started.append(new_program)
                     else:
-                        self.programs_dict[prog_name].assign_count(config["count"])
-                        self.programs_dict[prog_name].reload()
+                        resized.append((program, config, hashes[prog_name]))
                 except Exception as e:
                     print(
                         f"\033[33mWarning:\033[0m error reloading config file for {prog_name} ({str(e)})"
@@ -67,22 +207,41 @@ class ProgramsManager:
                 finally:
                     del confs[prog_name]
             else:
-                self.programs_dict[prog_name].kill()
-                del self.programs_dict[prog_name]
+                retired.append(self.programs_dict.pop(prog_name))
         for prog_name, config in confs.items():
-            self.programs_dict[prog_name] = Program(prog_name, config)
+            self.programs_dict[prog_name] = self._new_program(prog_name, config, hashes[prog_name])
             if self.programs_dict[prog_name].auto_start:
-                self.programs_dict[prog_name].execute()
+                started.append(self.programs_dict[prog_name])
+        return retired, resized, started
+
+    def state_samples(self):
+        for program in self.programs():
+            for state, value in program.counters().items():
+                yield (program.name, state), value
 
-    def status(self):
-        for _, program in self.programs_dict.items():
-            program.status()
+    def oom_samples(self):
+        for program in self.programs():
+            if program.cgroup is not None:
+                yield (program.name,), program.oom_kills()
 
-    def full_status(self):
-        for _, program in self.programs_dict.items():
-            program.full_status()
+    def stop(self, programs):
+        with self.locked(programs):
+            targets = []
+            for program in programs:
+                targets.extend(program.stop_targets())
+            supervisor.stop(targets)
+
+    def shutdown(self):
+        log.log("stopping all programs")
+        self.stop(self.programs())
+        listeners.close()
+        self.state.remove()
 
     def launch(self):
-        for _, program in self.programs_dict.items():
-            if program.auto_start:
-                program.execute()
+        programs = [program for program in self.programs() if program.auto_start]
+        Launcher(programs, skip=self.held).start()
+
+    def full_restart(self):
+        programs = self.programs()
+        self.stop(programs)
+        Launcher(programs).run()
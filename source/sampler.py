@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from array import array
+import settings
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+COLUMNS = ("cpu", "rss", "threads", "fds", "io")
+
+
+class ProcessStats:
+
+    __slots__ = ("pid", "ticks", "io_bytes", "sampled", "cpu", "rss", "threads", "fds", "io", "history", "index")
+
+    def __init__(self, pid, history_size):
+        self.pid = pid
+        self.ticks = None
+        self.io_bytes = None
+        self.sampled = None
+        self.cpu = 0.0
+        self.rss = 0
+        self.threads = 0
+        self.fds = 0
+        self.io = 0.0
+        self.history = array("f", bytes(4 * history_size))
+        self.index = 0
+
+    def recent_cpu(self):
+        """CPU% history, oldest first."""
+        return list(self.history[self.index :] + self.history[: self.index])
+
+
+def read_proc(pid):
+    with open(f"/proc/{pid}/stat", "rb") as stream:
+        fields = stream.read().rsplit(b")", 1)[1].split()
+    with open(f"/proc/{pid}/statm", "rb") as stream:
+        rss_pages = int(stream.read().split()[1])
+    io_bytes = None
+    try:
+        with open(f"/proc/{pid}/io", "rb") as stream:
+            io = dict(line.split(b": ") for line in stream.read().splitlines())
+        io_bytes = int(io[b"read_bytes"]) + int(io[b"write_bytes"])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        fds = 0
+    # fields start at stat's 3rd field: utime and stime are 14/15, num_threads 20
+    return int(fields[11]) + int(fields[12]), int(fields[17]), rss_pages * PAGE_SIZE, io_bytes, fds
+
+
+class Sampler:
+    """Samples every running child from /proc in one pass per interval."""
+
+    def __init__(self, programs, interval=settings.SAMPLE_INTERVAL, history_size=settings.SAMPLE_HISTORY):
+        self.programs = programs
+        self.interval = interval
+        self.history_size = history_size
+        self.stats = {}
+
+    def start(self):
+        if self.interval > 0:
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        stats = {}
+        for program in self.programs.programs():
+            for process in list(program.processes):
+                if not process.is_running():
+                    continue
+                pid = process.popen.pid
+                entry = self.stats.get(pid) or ProcessStats(pid, self.history_size)
+                try:
+                    self._update(entry, *read_proc(pid))
+                except (OSError, IndexError, ValueError):
+                    continue
+                stats[pid] = entry
+        self.stats = stats
+
+    def _update(self, entry, ticks, threads, rss, io_bytes, fds):
+        now = time.monotonic()
+        if entry.sampled is not None and now > entry.sampled:
+            elapsed = now - entry.sampled
+            entry.cpu = (ticks - entry.ticks) / CLOCK_TICKS / elapsed * 100
+            if io_bytes is not None and entry.io_bytes is not None:
+                entry.io = (io_bytes - entry.io_bytes) / elapsed
+            entry.history[entry.index] = entry.cpu
+            entry.index = (entry.index + 1) % len(entry.history)
+        entry.ticks, entry.io_bytes, entry.sampled = ticks, io_bytes, now
+        entry.rss, entry.threads, entry.fds = rss, threads, fds
+
+    def rows(self, programs, sort="cpu"):
+        if sort not in COLUMNS:
+            raise ValueError(f"Stats can be sorted by {', '.join(COLUMNS)}")
+        rows = []
+        for program in programs:
+            for process in list(program.processes):
+                entry = self.stats.get(process.popen.pid) if process.is_running() else None
+                if entry is None:
+                    continue
+                rows.append(
+                    {
+                        "program": program.name,
+                        "pid": entry.pid,
+                        "cpu": round(entry.cpu, 1),
+                        "rss": entry.rss,
+                        "threads": entry.threads,
+                        "fds": entry.fds,
+                        "io": round(entry.io),
+                        "history": [round(value, 1) for value in entry.recent_cpu()],
+                    }
+                )
+        return sorted(rows, key=lambda row: row[sort], reverse=True)
@@ -0,0 +1,150 @@
+import threading
+import time
+from log import logger as log
+from supervisor import supervisor
+import settings
+
+
+class Launcher:
+    """Starts the instances of several programs in priority order, honouring
+    depends_on and both a global and a per-program concurrency limit.
+
+    An instance holds its slot until it is ready: when a concurrency limit
+    applies, once it is promoted (start_time, at least a second); for programs
+    with start_gate, once it has lived start_time seconds; otherwise right
+    after spawning. An instance that exits is ready too. A program's
+    dependents start once all its instances are ready.
+    Processes in `skip` are left alone.
+    """
+
+    def __init__(self, programs, limit=settings.START_CONCURRENCY, skip=()):
+        self.programs = sorted(programs, key=lambda program: (program.priority, program.name))
+        self.limit = limit
+        self.skip = skip
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def _limited(self, program):
+        return bool(self.limit or program.start_concurrency)
+
+    def _ready(self, program, process):
+        if not (program.start_gate or self._limited(program)) or not process.is_running():
+            return True
+        return time.monotonic() >= self._ready_at(program, process)
+
+    def _ready_at(self, program, process):
+        if self._limited(program):
+            return process.start + max(program.start_time, 1)
+        return process.start + program.start_time
+
+    def _dependencies(self):
+        names = {program.name for program in self.programs}
+        dependencies = {}
+        for program in self.programs:
+            unknown = set(program.depends_on) - names
+            if unknown:
+                log.log(f"[{program.name}] ignoring dependencies not being started: {sorted(unknown)}")
+            dependencies[program.name] = set(program.depends_on) & names - {program.name}
+        return dependencies
+
+    def run(self):
+        dependencies = self._dependencies()
+        remaining = {
+            program.name: [process for process in program.processes if process not in self.skip]
+            for program in self.programs
+        }
+        inflight = {program.name: [] for program in self.programs}
+        done = set()
+        pending = list(self.programs)
+        while pending:
+            for program in pending:
+                inflight[program.name] = [
+                    process for process in inflight[program.name] if not self._ready(program, process)
+                ]
+                if not remaining[program.name] and not inflight[program.name]:
+                    done.add(program.name)
+            pending = [program for program in pending if program.name not in done]
+            busy = sum(len(processes) for processes in inflight.values())
+            startable = [
+                program
+                for program in pending
+                if remaining[program.name] and dependencies[program.name] <= done
+            ]
+            if not startable and not busy and pending:
+                log.log(f"dependency cycle between {sorted(p.name for p in pending)}, starting anyway")
+                for program in pending:
+                    dependencies[program.name] = set()
+                continue
+            for program in startable:
+                while remaining[program.name] and (not self.limit or busy < self.limit):
+                    if program.start_concurrency and len(inflight[program.name]) >= program.start_concurrency:
+                        break
+                    process = remaining[program.name].pop(0)
+                    with program.lock:
+                        if process.owner is not program or process.is_running():
+                            continue
+                        program.execute_processes([process])
+                    if not self._ready(program, process):
+                        inflight[program.name].append(process)
+                        busy += 1
+            self._wait(inflight)
+
+    def _wait(self, inflight):
+        deadlines = [
+            self._ready_at(program, process)
+            for program in self.programs
+            for process in inflight[program.name]
+        ]
+        if not deadlines:
+            return
+        with supervisor.exited:
+            supervisor.exited.wait(max(0, min(deadlines) - time.monotonic()))
+
+
+class RollingRestart:
+    """Replaces a program's instances `batch` at a time, moving on only once
+    the new ones are ready (see Program.readiness). If one of them fails, the
+    rollout stops and the instances not yet replaced keep running."""
+
+    def __init__(self, program, batch=1):
+        self.program = program
+        self.batch = max(batch, 1)
+
+    def run(self):
+        program = self.program
+        processes = list(program.processes)
+        restarted = 0
+        log.log(f"rolling restart of [{program.name}] by {self.batch}")
+        for index in range(0, len(processes), self.batch):
+            with program.lock:
+                batch = [process for process in processes[index : index + self.batch] if process.owner is program]
+                supervisor.stop(
+                    [(process, program.stop_signal, program.stop_time) for process in batch if process.is_running()]
+                )
+                for process in batch:
+                    process.retries = 0
+                program.execute_processes(batch)
+                started = [(process, process.popen) for process in batch]
+            failed = self._wait(started)
+            if failed:
+                log.log(f"rolling restart of [{program.name}] aborted, {failed} failed to start")
+                return {"restarted": restarted, "failed": failed, "aborted": True}
+            restarted += len(batch)
+        log.log(f"rolling restart of [{program.name}] done")
+        return {"restarted": restarted, "failed": 0, "aborted": False}
+
+    def _wait(self, started):
+        """Number of instances that did not become ready."""
+        while True:
+            with self.program.lock:
+                states = [self.program.readiness(process, popen) for process, popen in started]
+            if False in states or None not in states:
+                return states.count(False)
+            ready_at = min(
+                process.start + max(self.program.start_time, 1)
+                for (process, _), state in zip(started, states)
+                if state is None
+            )
+            with supervisor.exited:
+                supervisor.exited.wait(max(0.05, ready_at - time.monotonic()))
@@ -0,0 +1,30 @@
+import os
+
+CONTROL_SOCKET = os.environ.get("TASKMASTER_SOCKET", "/tmp/taskmaster.sock")
+CONTROL_ADDRESS = os.environ.get("TASKMASTER_CONTROL_ADDRESS")
+CONTROL_ALLOW_REMOTE = os.environ.get("TASKMASTER_CONTROL_ALLOW_REMOTE", "0") not in ("", "0", "false", "no")
+LOG_FILE = os.environ.get("TASKMASTER_LOG_FILE")
+LOG_QUEUE_SIZE = int(os.environ.get("TASKMASTER_LOG_QUEUE_SIZE", 10000))
+MAX_PROCESSES = int(os.environ.get("TASKMASTER_MAX_PROCESSES", 100))
+AUTO_RELOAD = os.environ.get("TASKMASTER_AUTO_RELOAD", "0") not in ("", "0", "false", "no")
+RELOAD_DEBOUNCE = float(os.environ.get("TASKMASTER_RELOAD_DEBOUNCE", 0.5))
+START_CONCURRENCY = int(os.environ.get("TASKMASTER_START_CONCURRENCY", 0))
+SAMPLE_INTERVAL = float(os.environ.get("TASKMASTER_SAMPLE_INTERVAL", 2))
+SAMPLE_HISTORY = int(os.environ.get("TASKMASTER_SAMPLE_HISTORY", 30))
+METRICS_ADDRESS = os.environ.get("TASKMASTER_METRICS_ADDRESS")
+METRICS_FILE = os.environ.get("TASKMASTER_METRICS_FILE")
+METRICS_INTERVAL = float(os.environ.get("TASKMASTER_METRICS_INTERVAL", 5))
+CGROUP_ROOT = os.environ.get("TASKMASTER_CGROUP_ROOT", "/sys/fs/cgroup/taskmaster")
+HEALTH_CONCURRENCY = int(os.environ.get("TASKMASTER_HEALTH_CONCURRENCY", 256))
+HEALTH_STOP_TIME = float(os.environ.get("TASKMASTER_HEALTH_STOP_TIME", 10))
+STATE_FILE = os.environ.get("TASKMASTER_STATE_FILE", "/tmp/taskmaster.state")
+STATE_INTERVAL = float(os.environ.get("TASKMASTER_STATE_INTERVAL", 1))
+CONFIG_CACHE = os.environ.get(
+    "TASKMASTER_CONFIG_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "taskmaster", "config.json")
+)
+JOURNAL_SIZE = int(os.environ.get("TASKMASTER_JOURNAL_SIZE", 16384))
+JOURNAL_FILE = os.environ.get("TASKMASTER_JOURNAL_FILE")
+JOURNAL_FILE_SIZE = int(os.environ.get("TASKMASTER_JOURNAL_FILE_SIZE", 16 * 1024 * 1024))
+JOURNAL_BACKUPS = int(os.environ.get("TASKMASTER_JOURNAL_BACKUPS", 3))
+FLEET_CONCURRENCY = int(os.environ.get("TASKMASTER_FLEET_CONCURRENCY", 64))
+FLEET_TIMEOUT = float(os.environ.get("TASKMASTER_FLEET_TIMEOUT", 5))
@@ -0,0 +1,168 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from log import logger as log
+import settings
+
+VERSION = 1
+
+
+def proc_start(pid):
+    """Start time of pid in clock ticks since boot, to tell a live child from a
+    reused pid; None for zombies and missing processes."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as stream:
+            fields = stream.read().rsplit(b")", 1)[1].split()
+    except OSError:
+        return None
+    if len(fields) < 20 or fields[0] == b"Z":
+        return None
+    return int(fields[19])
+
+
+def live_groups(pgids):
+    """The process groups among pgids that still have a member other than a zombie."""
+    alive = set()
+    for pgid in pgids:
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            continue
+        except PermissionError:
+            pass
+        alive.add(pgid)
+    if not alive:
+        return alive
+    # killpg also succeeds for groups of zombies left to an init that doesn't reap
+    found = set()
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat", "rb") as stream:
+                fields = stream.read().rsplit(b")", 1)[1].split()
+        except OSError:
+            continue
+        if fields[0] != b"Z" and int(fields[2]) in alive:
+            found.add(int(fields[2]))
+    return found
+
+
+class StateFile:
+    """Snapshot of the running children, rewritten whenever it changes so that
+    a new supervisor (after a crash or a re-exec) can adopt them. Instances
+    that were stopped or will not be restarted are recorded as `held`, so the
+    new supervisor leaves them down too.
+
+    save(inherit=True) runs right before a re-exec and marks the recorded pipe
+    and listener descriptors as still open in the new image. After a crash the
+    listeners are recovered from the children, but their output pipes are
+    gone: a child whose output was captured is killed by SIGPIPE on its next
+    write, unless it ignores SIGPIPE (then its writes fail with EPIPE)."""
+
+    def __init__(self, path=settings.STATE_FILE, interval=settings.STATE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last = None
+        self.claim_fd = None
+
+    def claim(self):
+        """Lock `<path>.lock` for this supervisor; another one already using the
+        state file (and so owning its children) makes this fail. The lock is
+        dropped on exit and across a re-exec, which takes it again."""
+        if not self.path:
+            return
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise ValueError(f"another taskmaster is using {self.path}")
+        self.claim_fd = fd
+
+    def snapshot(self, manager, inherit=False):
+        programs = {}
+        for program in manager.programs():
+            processes, held = [], []
+            for process in list(program.processes):
+                if not process.is_running():
+                    if process.launched and process.restart_due is None:
+                        held.append(
+                            {
+                                "instance": process.instance,
+                                "state": process.state.name,
+                                "stopped": process.kill_by_user,
+                                "retries": process.retries,
+                                "streak": process.streak,
+                            }
+                        )
+                    continue
+                entry = {
+                    "instance": process.instance,
+                    "pid": process.popen.pid,
+                    "proc_start": proc_start(process.popen.pid),
+                    "start": process.start,
+                    "retries": process.retries,
+                    "streak": process.streak,
+                }
+                if inherit:
+                    entry["fds"] = process.inherit_pipes()
+                processes.append(entry)
+            programs[program.name] = {"hash": program.config_hash, "processes": processes, "held": held}
+        return {
+            "version": VERSION,
+            "inherited": inherit,
+            "programs": programs,
+            "listeners": manager.listener_fds(),
+        }
+
+    def save(self, manager, inherit=False):
+        if not self.path:
+            return
+        with self.lock:
+            state = self.snapshot(manager, inherit)
+            if state == self.last:
+                return
+            try:
+                with open(f"{self.path}.tmp", "w") as stream:
+                    json.dump(state, stream, separators=(",", ":"))
+                os.replace(f"{self.path}.tmp", self.path)
+                self.last = state
+            except OSError as e:
+                log.log(f"cannot write state file {self.path}: {e}")
+
+    def load(self):
+        if not self.path:
+            return None
+        try:
+            with open(self.path) as stream:
+                state = json.load(stream)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.log(f"ignoring unreadable state file {self.path}: {e}")
+            return None
+        if state.get("version") != VERSION:
+            return None
+        return state
+
+    def remove(self):
+        """Called once every child is stopped; no more snapshots are written."""
+        with self.lock:
+            path, self.path = self.path, None
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+    def start(self, manager):
+        if not self.path or self.interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.interval)
+                self.save(manager)
+
+        threading.Thread(target=run, daemon=True).start()
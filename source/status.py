@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import namedtuple
+
+# fixed once, so a process's wall-clock start is the same in every snapshot
+WALL_OFFSET = time.time() - time.monotonic()
+
+# programs' entries carry their processes only in a `full` snapshot
+Snapshot = namedtuple("Snapshot", ("version", "time", "programs", "full"))
+
+
+def wall_time(monotonic):
+    return round(monotonic + WALL_OFFSET, 3)
+
+
+def diff(old, new, names=None):
+    """Programs whose entry changed between two snapshots, and those removed."""
+    changed = {
+        name: entry
+        for name, entry in new.programs.items()
+        if old.programs.get(name) != entry and (not names or name in names)
+    }
+    removed = sorted(
+        name for name in old.programs if name not in new.programs and (not names or name in names)
+    )
+    return {"version": new.version, "time": new.time, "changed": changed, "removed": removed}
+
+
+class StatusBoard:
+    """Publishes a snapshot of every program's status shortly after state
+    changes (coalescing bursts over `delay`). A snapshot and its entries are
+    never modified once published, so readers use them without any lock.
+
+    Only the counters are published unless someone asks for the processes
+    (full_status) or watches them, so that status stays O(programs)."""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.programs = None
+        self.snapshot = Snapshot(0, time.time(), {}, False)
+        self.watchers = 0
+        self.dirty = threading.Event()
+        self.publishing = threading.Lock()
+        self.published = threading.Condition()
+
+    def start(self, programs):
+        self.programs = programs
+        self.publish()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def changed(self):
+        self.dirty.set()
+
+    def current(self, full=False):
+        """The latest snapshot, published first if something changed since, so
+        a reader sees the effect of its own commands."""
+        if self.programs is not None and (self.dirty.is_set() or full and not self.snapshot.full):
+            self.dirty.clear()
+            self.publish(full)
+        return self.snapshot
+
+    def run(self):
+        while True:
+            self.dirty.wait()
+            time.sleep(self.delay)
+            self.dirty.clear()
+            self.publish()
+
+    def publish(self, full=False):
+        full = full or self.watchers > 0
+        with self.publishing:
+            programs = {program.name: program.snapshot(full) for program in self.programs.programs()}
+            with self.published:
+                self.snapshot = Snapshot(self.snapshot.version + 1, time.time(), programs, full)
+                self.published.notify_all()
+
+    def wait(self, version, timeout=None):
+        """The first snapshot newer than `version`, or the current one after timeout."""
+        with self.published:
+            self.published.wait_for(lambda: self.snapshot.version > version, timeout)
+            return self.snapshot
+
+    def watch(self, names=None, heartbeat=30):
+        """Yields the full status first, then only what changed; an empty diff
+        is only sent as a heartbeat, after `heartbeat` seconds without one."""
+        previous = Snapshot(0, 0, {}, True)
+        last = time.monotonic()
+        with self.published:
+            self.watchers += 1
+        try:
+            while True:
+                snapshot = self.wait(previous.version, max(0, last + heartbeat - time.monotonic()))
+                if not snapshot.full:
+                    snapshot = self.current(full=True)
+                changes = diff(previous, snapshot, names)
+                first, previous = previous.version == 0, snapshot
+                if first or changes["changed"] or changes["removed"] or time.monotonic() >= last + heartbeat:
+                    last = time.monotonic()
+                    yield changes
+        finally:
+            with self.published:
+                self.watchers -= 1
+
+
+board = StatusBoard()
@@ -0,0 +1,268 @@
+import functools
+import heapq
+import itertools
+import os
+import queue
+import selectors
+import signal
+import threading
+import time
+from enums import JournalEvent
+from journal import journal
+from log import logger as log
+from state import live_groups
+import metrics
+
+
+class Supervisor:
+    """Event loop waking only on child exits (pidfd or SIGCHLD) and due timers."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, self._on_wakeup)
+        self.use_pidfd = True
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.watched = {}
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.exited = threading.Condition()
+        self.events = queue.SimpleQueue()
+        self.deferred = {}
+
+    def start(self):
+        """Must be called from the main thread (SIGCHLD fallback needs it)."""
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except (AttributeError, OSError):
+            self.use_pidfd = False
+            signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+            signal.set_wakeup_fd(self.wakeup_w)
+        threading.Thread(target=self.run, daemon=True).start()
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    def _defer(self, operation):
+        with self.pending_lock:
+            self.pending.append(operation)
+        self.wakeup()
+
+    def watch(self, process):
+        self._defer(functools.partial(self._watch, process))
+
+    def add_reader(self, fd, callback):
+        """Call callback() from the loop thread whenever fd is readable;
+        the callback unregisters fd with remove_reader once done with it."""
+        self._defer(lambda: self.selector.register(fd, selectors.EVENT_READ, callback))
+
+    def remove_reader(self, fd):
+        """Only valid from the loop thread, i.e. inside a reader callback."""
+        self.selector.unregister(fd)
+
+    def call_at(self, deadline, lock, callback):
+        """Run callback holding lock (if not None) at the given monotonic time."""
+        with self.pending_lock:
+            heapq.heappush(self.timers, (deadline, next(self.timer_ids), lock, callback))
+        self.wakeup()
+
+    def call_later(self, delay, lock, callback):
+        self.call_at(time.monotonic() + delay, lock, callback)
+
+    def submit(self, lock, callback):
+        self.events.put((lock, callback))
+
+    def wait_exit(self, processes, timeout=None):
+        with self.exited:
+            return self.exited.wait_for(
+                lambda: not any(process.is_running() for process in processes), timeout
+            )
+
+    def stop(self, targets, by_user=True):
+        """Signal every (process, stop_signal, stop_time) target at once and wait
+        for all of them together; a SIGKILL deadline is queued for each one
+        with a stop_time (0 waits for the exit, as before)."""
+        stopping, groups = [], {}
+        for process, stop_signal, stop_time in targets:
+            if self.terminate(process, stop_signal, stop_time, by_user):
+                stopping.append(process)
+                if process.group:
+                    # past the SIGKILL deadline, give up on members we cannot kill
+                    groups[process.popen.pid] = time.monotonic() + stop_time + 1 if stop_time > 0 else None
+        self.wait_exit(stopping)
+        self._wait_groups(groups)
+        for process in stopping:
+            process.stopped()
+
+    def _wait_groups(self, groups):
+        """Members of a stopped group can outlive its leader (a shell that died
+        on the stop signal): wait for the whole group, up to its deadline."""
+        while groups:
+            now = time.monotonic()
+            pending = {pgid for pgid, deadline in groups.items() if deadline is None or now < deadline}
+            groups = {pgid: groups[pgid] for pgid in live_groups(pending)}
+            if groups:
+                time.sleep(0.05)
+
+    def terminate(self, process, stop_signal, stop_time, by_user=True):
+        """Signal a process and queue its SIGKILL deadline, if any, without waiting."""
+        process.kill_by_user = by_user
+        if not process.send_stop_signal(stop_signal):
+            return False
+        journal.record(
+            JournalEvent.STOP, process.name, process.instance, process.popen.pid, stop_signal, stop_time
+        )
+        if stop_time > 0:
+            self.call_later(
+                stop_time, None, functools.partial(self._escalate, process, process.popen, process.group)
+            )
+        return True
+
+    def _escalate(self, process, popen, group):
+        if group:
+            # the leader may be gone already while the rest of its group ignores the stop signal
+            try:
+                os.killpg(popen.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                return
+            log.log(f"stop_time exceeded, killing the process group of [pid:{popen.pid}]")
+        elif process.popen is popen and popen.returncode is None:
+            log.log(f"stop_time exceeded, killing [pid:{popen.pid}]")
+            process.send_stop_signal(signal.SIGKILL)
+        else:
+            return
+        journal.record(JournalEvent.KILL, process.name, process.instance, popen.pid, signal.SIGKILL)
+
+    def _run_pending(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+        for operation in pending:
+            operation()
+
+    def _watch(self, process):
+        pid = process.popen.pid
+        if not self.use_pidfd:
+            self.watched[pid] = process
+            if self._reap(process):
+                del self.watched[pid]
+            return
+        try:
+            pidfd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            self._reap(process)
+            return
+        self.selector.register(
+            pidfd, selectors.EVENT_READ, functools.partial(self._on_pidfd, pidfd, process)
+        )
+
+    def _on_pidfd(self, pidfd, process):
+        self.selector.unregister(pidfd)
+        os.close(pidfd)
+        self._reap(process)
+
+    def _reap(self, process):
+        try:
+            pid, status = os.waitpid(process.popen.pid, os.WNOHANG)
+        except ChildProcessError:
+            pid, status = process.popen.pid, None
+        if pid == 0:
+            return False
+        process.reaped(status)
+        metrics.exits.inc(process.name, process.popen.returncode)
+        with self.exited:
+            self.exited.notify_all()
+        owner = process.owner
+        if owner is not None:
+            self.submit(owner.lock, lambda: owner.check_process(process))
+        return True
+
+    def _reap_watched(self):
+        for pid, process in list(self.watched.items()):
+            if self._reap(process):
+                del self.watched[pid]
+
+    def _on_wakeup(self):
+        try:
+            while os.read(self.wakeup_r, 512):
+                pass
+        except BlockingIOError:
+            pass
+        if not self.use_pidfd:
+            self._reap_watched()
+
+    def _next_timeout(self):
+        with self.pending_lock:
+            if not self.timers:
+                return None
+            return max(0, self.timers[0][0] - time.monotonic())
+
+    def _run_timers(self):
+        now = time.monotonic()
+        with self.pending_lock:
+            while self.timers and self.timers[0][0] <= now:
+                _, _, lock, callback = heapq.heappop(self.timers)
+                self.events.put((lock, callback))
+
+    def run(self):
+        while True:
+            events = self.selector.select(self._next_timeout())
+            woke = time.monotonic()
+            for key, _ in events:
+                try:
+                    key.data()
+                except Exception as e:
+                    log.log(f"supervisor event handler failed: {e}")
+            self._run_pending()
+            self._run_timers()
+            metrics.loop_seconds.observe(time.monotonic() - woke)
+
+    def dispatch(self):
+        """Run callbacks in order; a callback whose lock is busy is handed, with
+        every later callback for the same lock, to a helper thread so that one
+        stuck program never delays the others."""
+        while True:
+            lock, callback = self.events.get()
+            if lock is None:
+                self._call(callback)
+                continue
+            with self.pending_lock:
+                backlog = self.deferred.get(lock)
+                if backlog is not None:
+                    backlog.append(callback)
+                    continue
+                if not lock.acquire(blocking=False):
+                    self.deferred[lock] = [callback]
+                    threading.Thread(target=self._drain_deferred, args=(lock,), daemon=True).start()
+                    continue
+            try:
+                self._call(callback)
+            finally:
+                lock.release()
+
+    def _drain_deferred(self, lock):
+        with lock:
+            while True:
+                with self.pending_lock:
+                    callbacks = self.deferred[lock]
+                    if not callbacks:
+                        del self.deferred[lock]
+                        return
+                    self.deferred[lock] = []
+                for callback in callbacks:
+                    self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception as e:
+            log.log(f"supervisor callback failed: {e}")
+
+
+supervisor = Supervisor()
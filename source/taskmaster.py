@@ -1,29 +1,131 @@
+import argparse
 import os
-import threading
+import signal
 import interface
-import time
+from config import ConfigWatcher
+from control import ControlServer, ControlTCPServer
 from programsManager import ProgramsManager
+from supervisor import supervisor
+from status import board
+from log import logger as log
+import metrics
+import settings
 
 
-def check_programs(thread_lock, programs):
-    while True:
-        thread_lock.acquire(True)
-        for program in programs.programs():
-            program.check()
-        thread_lock.release()
-        time.sleep(0.1)
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Supervise the programs described in the config files.")
+    parser.add_argument("files", nargs="*", metavar="conf.yaml")
+    parser.add_argument("--daemon", action="store_true", help="run in the background without a shell")
+    parser.add_argument("--pidfile", help="write the supervisor's pid to this file")
+    parser.add_argument(
+        "--state-file",
+        default=settings.STATE_FILE,
+        help="where running children are recorded for re-adoption ('' to disable)",
+    )
+    return parser.parse_args()
+
+
+def daemonize():
+    if os.fork():
+        os._exit(os.EX_OK)
+    os.setsid()
+    if os.fork():
+        os._exit(os.EX_OK)
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    os.close(null)
+
+
+def run_daemon(programs):
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGHUP, lambda *_: programs.reload())
+    log.log("taskmaster running as a daemon")
+    while not stopping:
+        signal.pause()
 
 
 if __name__ == "__main__":
 
-    lock = threading.Lock()
+    options = parse_arguments()
+    if settings.CONTROL_ADDRESS:
+        # refused before detaching, while the error can still be seen
+        try:
+            ControlTCPServer.check(settings.CONTROL_ADDRESS)
+        except ValueError as e:
+            print(f"\033[31m Error:\033[0m {str(e)}")
+            exit(os.EX_USAGE)
+    reexecuted = os.environ.pop("TASKMASTER_REEXEC", None)
+    if options.daemon and not reexecuted:
+        daemonize()
     try:
-        programs = ProgramsManager()
+        programs = ProgramsManager(options.files)
+        programs.state.path = options.state_file
+        # refuse to run next to another taskmaster before touching any child
+        programs.state.claim()
+        control = ControlServer(settings.CONTROL_SOCKET, programs)
+        if options.pidfile:
+            with open(options.pidfile, "w") as stream:
+                stream.write(f"{os.getpid()}\n")
         programs.load()
+        supervisor.start()
+        programs.adopt()
         programs.launch()
-        daemon = threading.Thread(target=check_programs, args=(lock, programs), daemon=True)
-        daemon.start()
-        interface.Interface(programs, lock).cmdloop()
+        board.start(programs)
+        programs.state.start(programs)
+        programs.sampler.start()
+        programs.health.start()
+        metrics.registry.gauge(
+            "taskmaster_processes",
+            "Processes per program and state.",
+            ("program", "state"),
+            programs.state_samples,
+        )
+        metrics.registry.gauge(
+            "taskmaster_oom_kills",
+            "OOM kills recorded in each program's cgroup.",
+            ("program",),
+            programs.oom_samples,
+        )
+        if settings.METRICS_ADDRESS:
+            metrics.serve(settings.METRICS_ADDRESS)
+        if settings.METRICS_FILE:
+            metrics.write_periodically(settings.METRICS_FILE, settings.METRICS_INTERVAL)
+        control.start()
+        remote = None
+        if settings.CONTROL_ADDRESS:
+            remote = ControlTCPServer(settings.CONTROL_ADDRESS, programs)
+            remote.start()
+        if settings.AUTO_RELOAD:
+            ConfigWatcher(programs.files, programs.reload, settings.RELOAD_DEBOUNCE).start()
+        signal.signal(signal.SIGUSR2, lambda *_: programs.reexec())
+        crashed = False
+        try:
+            if options.daemon:
+                run_daemon(programs)
+            else:
+                interface.Interface(programs).cmdloop()
+        except Exception as e:
+            # exit, EOF and signals end the loop normally: this is a crash, so the
+            # children are left running for the next taskmaster to adopt
+            crashed = bool(programs.state.path)
+            if crashed:
+                log.log(f"taskmaster crashed ({e}), leaving the children running")
+                programs.state.save(programs)
+            raise
+        finally:
+            control.close()
+            if remote is not None:
+                remote.close()
+            if not crashed:
+                programs.shutdown()
+            if options.pidfile and os.path.exists(options.pidfile):
+                os.unlink(options.pidfile)
+            log.flush()
     except Exception as e:
+        log.log(f"taskmaster stopped: {e}")
+        log.flush()
         print(f"\033[31m Error:\033[0m {str(e)}")
         exit(os.EX_OK)
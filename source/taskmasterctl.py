@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import settings
+
+
+def parse_commands(words):
+    """Split `start a b ; stop c` into [{"cmd": "start", ...}, {"cmd": "stop", ...}]."""
+    commands, current = [], []
+    for word in words + [";"]:
+        if word != ";":
+            current.append(word)
+        elif current:
+            commands.append({"cmd": current[0], "args": current[1:]})
+            current = []
+    return commands
+
+
+def send(path, commands, timeout=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(json.dumps(commands).encode() + b"\n")
+        with client.makefile("rb") as stream:
+            return json.loads(stream.readline())
+
+
+def watch(path, names, timeout=None):
+    """Print status changes as JSON lines until interrupted."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(json.dumps({"cmd": "watch", "args": names}).encode() + b"\n")
+        with client.makefile("rb") as stream:
+            for line in stream:
+                print(json.dumps(json.loads(line)["result"]), flush=True)
+
+
+def fleet(nodes, commands, options):
+    from fleet import Fleet
+
+    if any(command["cmd"] == "watch" for command in commands):
+        print("taskmasterctl: watch goes to one node at a time", file=sys.stderr)
+        return os.EX_USAGE
+    try:
+        responses = Fleet(nodes, options.concurrency, options.timeout or settings.FLEET_TIMEOUT).execute(commands)
+    except ValueError as e:
+        print(f"taskmasterctl: {e}", file=sys.stderr)
+        return os.EX_USAGE
+    failed = False
+    for command, response in zip(commands, responses):
+        if response["ok"]:
+            failed = failed or bool(response["result"]["errors"])
+            print(json.dumps(response["result"]))
+        else:
+            failed = True
+            print(f"{command['cmd']}: {response['error']}", file=sys.stderr)
+    return 1 if failed else os.EX_OK
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Send commands to a running taskmaster; separate several commands with ';'."
+    )
+    parser.add_argument("-s", "--socket", default=settings.CONTROL_SOCKET)
+    parser.add_argument("-f", "--file", help="read one command per line ('-' for stdin)")
+    parser.add_argument("-t", "--timeout", type=float, default=None)
+    parser.add_argument(
+        "-n",
+        "--node",
+        action="append",
+        default=[],
+        help="send to this control endpoint (socket path or host:port); repeat for a fleet",
+    )
+    parser.add_argument("--nodes", help="read fleet endpoints from a file, one per line")
+    parser.add_argument("-j", "--concurrency", type=int, default=settings.FLEET_CONCURRENCY)
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    options = parser.parse_args()
+
+    words = list(options.command)
+    if options.file:
+        stream = sys.stdin if options.file == "-" else open(options.file)
+        with stream:
+            for line in stream:
+                words.extend(line.split() + [";"])
+    commands = parse_commands(words)
+    if not commands:
+        parser.print_usage()
+        return os.EX_USAGE
+
+    nodes = list(options.node)
+    if options.nodes:
+        with open(options.nodes) as stream:
+            nodes.extend(line.strip() for line in stream if line.strip() and not line.startswith("#"))
+    if nodes:
+        return fleet(nodes, commands, options)
+    if commands[0]["cmd"] == "watch":
+        try:
+            watch(options.socket, commands[0]["args"], options.timeout)
+        except KeyboardInterrupt:
+            return os.EX_OK
+        except (OSError, ValueError) as e:
+            print(f"taskmasterctl: cannot reach {options.socket} ({e})", file=sys.stderr)
+            return os.EX_UNAVAILABLE
+        return os.EX_OK
+    try:
+        responses = send(options.socket, commands, options.timeout)
+    except (OSError, ValueError) as e:
+        print(f"taskmasterctl: cannot reach {options.socket} ({e})", file=sys.stderr)
+        return os.EX_UNAVAILABLE
+    failed = False
+    for command, response in zip(commands, responses):
+        if response["ok"]:
+            print(json.dumps(response["result"]))
+        else:
+            failed = True
+            print(f"{command['cmd']}: {response['error']}", file=sys.stderr)
+    return 1 if failed else os.EX_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())